@@ -0,0 +1,270 @@
+"""
+Benchmark the protocol KEP-AP for a list of pool sizes.
+
+For each pool size, the program is compiled once without the compilation cache and then run a number of times with
+all patient-donor pairs in a single client process. The wall times of the eight protocol phases and the communication
+statistics of all computing peers are parsed from the output of MP-SPDZ, and the compile time and the peak memory of
+the compiler and of each computing peer are recorded. The results are written as JSON and CSV and can be compared
+against the JSON output of an earlier benchmark.
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import run_kep_ap
+
+# timers of KEP_AP.mpc
+TIMERS = {1: "input", 2: "construction", 3: "shuffle", 4: "evaluation", 5: "optimization", 6: "resolution",
+          7: "unshuffle", 8: "output"}
+
+TOTAL_PATTERN = re.compile(r"^Time = ([\d.e+-]+) seconds", re.M)
+TIMER_PATTERN = re.compile(r"^Time(\d+) = ([\d.e+-]+) seconds(?: \(([\d.e+-]+) MB(?:, (\d+) rounds)?\))?", re.M)
+DATA_PATTERN = re.compile(r"^Data sent = ([\d.e+-]+) MB(?: in ~(\d+) rounds)?", re.M)
+GLOBAL_DATA_PATTERN = re.compile(r"^Global data sent = ([\d.e+-]+) MB", re.M)
+
+# interval in which running processes are checked
+POLL_SECONDS = 0.1
+
+# metrics of the summary and of the comparison with a baseline, lower is better for all of them
+METRICS = ["compile_seconds", "compile_peak_rss_kb", "total_seconds", "global_data_sent_mb"] + \
+          [f"time_{name}" for name in TIMERS.values()]
+
+
+def wait_with_usage(popen):
+    """
+    Wait for a process started with subprocess.Popen and return its peak resident set size in KiB.
+    """
+    return wait_all_with_usage([popen])[0]
+
+
+def wait_all_with_usage(popens, timeout=None):
+    """
+    Wait for processes started with subprocess.Popen and return their peak resident set sizes in KiB. Raises
+    CalledProcessError as soon as one of the processes fails and TimeoutExpired if they are not finished after timeout
+    seconds, so that a process does not wait forever for a failed process.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    peak_rss = {}
+    while True:
+        for i, popen in enumerate(popens):
+            if i in peak_rss:
+                continue
+            pid, status, usage = os.wait4(popen.pid, os.WNOHANG)
+            if not pid:
+                continue
+            popen.returncode = os.waitstatus_to_exitcode(status)
+            if popen.returncode:
+                raise subprocess.CalledProcessError(popen.returncode, popen.args)
+            peak_rss[i] = usage.ru_maxrss
+        if len(peak_rss) == len(popens):
+            return [peak_rss[i] for i in range(len(popens))]
+        if deadline is not None and time.monotonic() > deadline:
+            raise subprocess.TimeoutExpired(popens[0].args, timeout)
+        time.sleep(POLL_SECONDS)
+
+
+def read_log(file):
+    file.seek(0)
+    return file.read()
+
+
+def compile_program(clients, packed, ring=False, threads=1, until=None):
+    """
+    Compile KEP_AP for the given number of patient-donor pairs and store the result in the compilation cache. Returns
+    the compile time, the peak memory of the compiler, and the output of the compiler. With until, only the phases up
+    to the given timer are compiled.
+    """
+    args = run_kep_ap.program_args(clients, packed, ring, threads, until=until)
+    flags = run_kep_ap.compiler_flags(ring)
+    with tempfile.TemporaryFile("w+") as log:
+        start = time.perf_counter()
+        popen = subprocess.Popen(["../MPSPDZ/compile.py"] + flags + args, stdout=log, stderr=subprocess.STDOUT,
+                                 cwd="./smpc_protocols")
+        peak_rss = wait_with_usage(popen)
+        seconds = time.perf_counter() - start
+        output = read_log(log)
+
+    run_kep_ap.store_requirements("-".join(args), output)
+    run_kep_ap.store_in_cache(run_kep_ap.compile_cache_key(args, flags), "-".join(args))
+    return {"compile_seconds": seconds, "compile_peak_rss_kb": peak_rss, "compile_output": output}
+
+
+def parse_party_output(output):
+    """
+    Total time, phase times, and communication statistics printed by a computing peer.
+    """
+    total = TOTAL_PATTERN.search(output)
+    data = DATA_PATTERN.search(output)
+    global_data = GLOBAL_DATA_PATTERN.search(output)
+    timers = {}
+    for match in TIMER_PATTERN.finditer(output):
+        if int(match.group(1)) in TIMERS:
+            timers[TIMERS[int(match.group(1))]] = {
+                "seconds": float(match.group(2)),
+                "data_sent_mb": float(match.group(3)) if match.group(3) else None,
+                "rounds": int(match.group(4)) if match.group(4) else None}
+
+    return {"total_seconds": float(total.group(1)) if total else None,
+            "timers": timers,
+            "data_sent_mb": float(data.group(1)) if data else None,
+            "rounds": int(data.group(2)) if data and data.group(2) else None,
+            "global_data_sent_mb": float(global_data.group(1)) if global_data else None}
+
+
+def run_once(clients, packed, protocol=run_kep_ap.PROTOCOL, batch_size=run_kep_ap.BATCHSIZE, threads=1,
+             timeout=None):
+    """
+    Run the compiled program once with all patient-donor pairs in a single client process and return the parsed
+    statistics of all computing peers. If a process fails or the run takes longer than timeout seconds, all other
+    processes of the run are stopped and CalledProcessError or TimeoutExpired is raised.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    program = "-".join(run_kep_ap.program_args(clients, packed, run_kep_ap.is_ring(protocol), threads))
+    logs = [tempfile.TemporaryFile("w+") for _ in range(run_kep_ap.COMPUTING_PEERS)]
+    processes = []
+    try:
+        parties = [subprocess.Popen(run_kep_ap.party_command(i, program, protocol, batch_size), stdout=logs[i],
+                                    stderr=subprocess.STDOUT, cwd="./smpc_protocols", universal_newlines=True)
+                   for i in range(run_kep_ap.COMPUTING_PEERS)]
+        processes = list(parties)
+        driver = run_kep_ap.start_client_driver(clients, packed)
+        processes.append(driver)
+        peak_rss = wait_all_with_usage(parties, timeout)
+        driver.communicate(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+        if driver.returncode:
+            raise subprocess.CalledProcessError(driver.returncode, driver.args)
+
+        results = [parse_party_output(read_log(log)) for log in logs]
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+        raise
+    finally:
+        for log in logs:
+            log.close()
+
+    for result, peak in zip(results, peak_rss):
+        result["peak_rss_kb"] = peak
+    return results
+
+
+def summarize_run(parties):
+    """
+    Per-run metrics. A phase is only finished once all computing peers finished it, so the phase times are the
+    maximum over all computing peers.
+    """
+    row = {"total_seconds": max(party["total_seconds"] or 0 for party in parties),
+           "global_data_sent_mb": next((party["global_data_sent_mb"] for party in parties
+                                        if party["global_data_sent_mb"] is not None), None)}
+    for name in TIMERS.values():
+        times = [party["timers"][name]["seconds"] for party in parties if name in party["timers"]]
+        row[f"time_{name}"] = max(times) if times else None
+    return row
+
+
+def csv_row(record):
+    row = {key: record[key] for key in ["pairs", "repetition", "compile_seconds", "compile_peak_rss_kb"]}
+    row.update(summarize_run(record["parties"]))
+    for i, party in enumerate(record["parties"]):
+        row[f"party{i}_data_sent_mb"] = party["data_sent_mb"]
+        row[f"party{i}_rounds"] = party["rounds"]
+        row[f"party{i}_peak_rss_kb"] = party["peak_rss_kb"]
+    return row
+
+
+def summarize(rows):
+    """
+    Median of each metric over all repetitions, per pool size.
+    """
+    summary = {}
+    for pairs in sorted({row["pairs"] for row in rows}):
+        runs = [row for row in rows if row["pairs"] == pairs]
+        summary[str(pairs)] = {metric: statistics.median([run[metric] for run in runs if run[metric] is not None])
+                               for metric in METRICS if any(run[metric] is not None for run in runs)}
+    return summary
+
+
+def compare(summary, baseline, tolerance):
+    """
+    Compare the summary with the summary of a baseline benchmark. Returns the list of comparisons as tuples
+    (pairs, metric, baseline value, current value, ratio, regression).
+    """
+    comparisons = []
+    for pairs, metrics in summary.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(pairs, {}).get(metric)
+            if not reference:
+                continue
+            ratio = value / reference
+            comparisons.append((pairs, metric, reference, value, ratio, ratio > 1 + tolerance))
+    return comparisons
+
+
+def print_comparison(comparisons):
+    print(f"{'pairs':>6} {'metric':<24} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for pairs, metric, reference, value, ratio, regression in comparisons:
+        color = run_kep_ap.OUTPUT_COLORS[3] if regression else ""
+        end = run_kep_ap.END_COLOR if regression else ""
+        print(f"{color}{pairs:>6} {metric:<24} {reference:>12.4g} {value:>12.4g} {ratio:>7.3f}{end}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the protocol KEP-AP for a list of pool sizes.")
+    parser.add_argument("pairs", nargs="+", type=int, help="numbers of patient-donor pairs")
+    parser.add_argument("--repetitions", type=int, default=3, help="number of runs per pool size")
+    parser.add_argument("--packed", action="store_true", help="send the HLA indicator vectors bit-packed")
+    parser.add_argument("--domain", choices=sorted(run_kep_ap.PROTOCOLS), default="field",
+                        help="computation domain, run with the default protocol of the domain")
+    parser.add_argument("--threads", type=int, default=1, help="number of threads of each computing peer")
+    parser.add_argument("--output", default="benchmark_kep_ap",
+                        help="prefix of the result files <output>.json and <output>.csv")
+    parser.add_argument("--baseline", help="JSON output of an earlier benchmark to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown against the baseline that is reported as regression")
+    args = parser.parse_args()
+
+    protocol = run_kep_ap.PROTOCOLS[args.domain]
+    run_kep_ap.generate_random_input(max(args.pairs))
+    run_kep_ap.setup(max(args.pairs), protocol)
+
+    records = []
+    for pairs in args.pairs:
+        compilation = compile_program(pairs, args.packed, args.domain == "ring", args.threads)
+        for repetition in range(args.repetitions):
+            print(f"Running KEP_AP for {pairs} pairs ({repetition + 1}/{args.repetitions})")
+            records.append({"pairs": pairs, "repetition": repetition,
+                            "compile_seconds": compilation["compile_seconds"],
+                            "compile_peak_rss_kb": compilation["compile_peak_rss_kb"],
+                            "parties": run_once(pairs, args.packed, protocol, threads=args.threads)})
+
+    rows = [csv_row(record) for record in records]
+    summary = summarize(rows)
+    with open(args.output + ".json", "w") as file:
+        json.dump({"packed": args.packed, "protocol": protocol, "threads": args.threads,
+                   "repetitions": args.repetitions, "runs": records, "summary": summary}, file, indent=2)
+    with open(args.output + ".csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Results written to {args.output}.json and {args.output}.csv")
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            comparisons = compare(summary, json.load(file)["summary"], args.tolerance)
+        print_comparison(comparisons)
+        if any(comparison[-1] for comparison in comparisons):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
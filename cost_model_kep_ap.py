@@ -0,0 +1,192 @@
+"""
+Predict the cost of the protocol KEP-AP for a pool size without running it.
+
+The program is compiled for a few small pool sizes, once up to the end of each protocol phase (see 'until=<timer>' in
+KEP_AP.mpc), and the statistics printed by the MP-SPDZ compiler (required triples, bits, edaBits, virtual machine
+rounds, ...) of each phase are the differences between consecutive compilations. The memory of each computing peer
+follows from the memory sizes printed by the compiler and the size of a memory cell (see memory_cell_bytes). Each metric is fitted by
+a + b * g(n) for each of the growth models g in GROWTH_MODELS, where n is the number of patient-donor pairs, and the
+model with the smallest maximum relative error over the compiled sizes is evaluated for the target pool size. This
+error is reported as fit error; a large fit error means that none of the models describes the metric.
+
+With the JSON output of benchmark_kep_ap.py, the measured runtime of each phase, the communication, and the peak
+memory of the computing peers are fitted and extrapolated in the same way.
+"""
+
+import argparse
+import json
+import math
+
+import numpy
+
+import benchmark_kep_ap
+import run_kep_ap
+
+
+def subsets(n):
+    return math.comb(n, 2) + math.comb(n, 3)
+
+
+# Growth models of the metrics: linear in the input and output, quadratic in the matrices of the construction and
+# (un)shuffling, cubic in the subsets of the evaluation and resolution phases, and n / 2 iterations over all subsets
+# in the optimization phase, whose rounds grow with the depth log(S) of its tournament.
+GROWTH_MODELS = {"n": lambda n: n,
+                 "n^2": lambda n: n ** 2,
+                 "n^3": lambda n: n ** 3,
+                 "n^4": lambda n: n ** 4,
+                 "n log S": lambda n: n * math.log2(max(subsets(n), 2))}
+
+def memory_cell_bytes(ring):
+    """
+    Bytes per memory cell of a computing peer by memory type of MP-SPDZ: with replicated secret sharing, each computing
+    peer holds two shares of each secret value; integers (ci) have 64 bits.
+    """
+    element = (run_kep_ap.RING_BITS if ring else run_kep_ap.FIELD_BITS) // 8
+    return {"s": 2 * element, "c": element, "ci": 8}
+
+
+# metrics of benchmark_kep_ap.py that are extrapolated
+MEASURED_METRICS = ["total_seconds", "global_data_sent_mb"] + \
+                   [f"time_{name}" for name in benchmark_kep_ap.TIMERS.values()]
+
+
+def fit_model(sizes, values, growth):
+    """
+    Least-squares fit of a + b * growth(n) with b >= 0. Returns (a, b).
+    """
+    design = numpy.array([[1, growth(n)] for n in sizes], dtype=float)
+    (a, b), *_ = numpy.linalg.lstsq(design, numpy.array(values, dtype=float), rcond=None)
+    if b < 0:
+        return float(numpy.mean(values)), 0.0
+    return float(a), float(b)
+
+
+def relative_error(predicted, actual):
+    return abs(predicted - actual) / abs(actual) if actual else abs(predicted)
+
+
+def fit(sizes, values):
+    """
+    Fit all growth models and select the one with the smallest fit error, the maximum relative error over all sizes.
+    Returns (model name, a, b, fit error).
+    """
+    best = None
+    for name, growth in GROWTH_MODELS.items():
+        a, b = fit_model(sizes, values, growth)
+        error = max(relative_error(a + b * growth(n), value) for n, value in zip(sizes, values))
+        if best is None or error < best[3]:
+            best = name, a, b, error
+    return best
+
+
+def predict(sizes, samples, target):
+    """
+    Fit each metric of the samples (one dictionary per size) and evaluate it at the target size. Returns, per metric,
+    the predicted value, the growth model, and the fit error.
+    """
+    predictions = {}
+    for metric in sorted({metric for sample in samples for metric in sample}):
+        points = sorted((n, sample[metric]) for n, sample in zip(sizes, samples) if sample.get(metric) is not None)
+        if len(points) < 3:
+            continue
+        model, a, b, error = fit([n for n, _ in points], [value for _, value in points])
+        predictions[metric] = {"value": a + b * GROWTH_MODELS[model](target), "model": model, "fit_error": error}
+    return predictions
+
+
+def print_predictions(title, predictions):
+    print(title)
+    for metric, prediction in predictions.items():
+        print(f"  {metric:<40} {prediction['value']:>16.6g}  "
+              f"(a + b * {prediction['model']}, fit error {prediction['fit_error']:.1%})")
+
+
+def memory_statistics(output, ring):
+    """
+    Memory cells of each type and the resulting memory in bytes of each computing peer, from the output of the compiler.
+    """
+    sizes = run_kep_ap.parse_memory_sizes(output)
+    statistics = {f"memory cells {memory}": size for memory, size in sizes.items()}
+    if sizes:
+        cell_bytes = memory_cell_bytes(ring)
+        statistics["party_memory_bytes"] = sum(size * cell_bytes.get(memory, 0) for memory, size in sizes.items())
+    return statistics
+
+
+def phase_statistics(n, packed, ring):
+    """
+    Statistics of the compiler for each phase: the program is compiled up to the end of each phase and the statistics
+    of the previous compilation are subtracted. Also returns the statistics, the memory, and the compile time and
+    memory of the whole program.
+    """
+    phases = {}
+    previous = {}
+    for timer, name in benchmark_kep_ap.TIMERS.items():
+        compilation = benchmark_kep_ap.compile_program(n, packed, ring, until=timer)
+        statistics = run_kep_ap.parse_program_statistics(compilation["compile_output"])
+        phases[name] = {metric: value - previous.get(metric, 0) for metric, value in statistics.items()}
+        previous = statistics
+
+    compilation = benchmark_kep_ap.compile_program(n, packed, ring)
+    total = run_kep_ap.parse_program_statistics(compilation["compile_output"])
+    total.update(memory_statistics(compilation["compile_output"], ring))
+    total["compile_seconds"] = compilation["compile_seconds"]
+    total["compile_peak_rss_kb"] = compilation["compile_peak_rss_kb"]
+    return phases, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Predict the cost of KEP-AP for a pool size from small compilations.")
+    parser.add_argument("target", type=int, help="number of patient-donor pairs to predict the cost for")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[4, 6, 8, 10, 12, 14],
+                        help="at least three pool sizes to compile; even sizes avoid rounding of the number of "
+                             "iterations")
+    parser.add_argument("--packed", action="store_true", help="send the HLA indicator vectors bit-packed")
+    parser.add_argument("--domain", choices=sorted(run_kep_ap.PROTOCOLS), default="field", help="computation domain")
+    parser.add_argument("--benchmark", help="JSON output of benchmark_kep_ap.py to extrapolate runtime, "
+                                            "communication, and memory from")
+    parser.add_argument("--output", help="write the predictions to this JSON file")
+    args = parser.parse_args()
+    if len(set(args.sizes)) < 3:
+        parser.error("at least three different pool sizes are required")
+
+    sizes = sorted(set(args.sizes))
+    # the program is only compiled, so neither inputs nor certificates are needed
+    run_kep_ap.sync_sources(inputs=False)
+
+    phases, totals = [], []
+    for n in sizes:
+        print(f"Compiling KEP_AP for {n} pairs")
+        phase, total = phase_statistics(n, args.packed, args.domain == "ring")
+        phases.append(phase)
+        totals.append(total)
+
+    report = {"target": args.target, "sizes": sizes,
+              "compiler": predict(sizes, totals, args.target),
+              "phases": {name: predict(sizes, [phase[name] for phase in phases], args.target)
+                         for name in benchmark_kep_ap.TIMERS.values()}}
+    print_predictions(f"\nPredicted program statistics for {args.target} pairs:", report["compiler"])
+    for name, predictions in report["phases"].items():
+        print_predictions(f"\nPredicted program statistics of the {name} phase:", predictions)
+
+    if args.benchmark:
+        with open(args.benchmark, "r") as file:
+            benchmark = json.load(file)
+        measured_sizes = sorted(int(n) for n in benchmark["summary"])
+        runs = []
+        for n in measured_sizes:
+            measured = {metric: benchmark["summary"][str(n)].get(metric) for metric in MEASURED_METRICS}
+            measured["party_peak_rss_kb"] = max(party["peak_rss_kb"] for record in benchmark["runs"]
+                                                if record["pairs"] == n for party in record["parties"])
+            runs.append(measured)
+        report["measured"] = predict(measured_sizes, runs, args.target)
+        print_predictions(f"\nPredicted runtime, communication, and memory for {args.target} pairs:",
+                          report["measured"])
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
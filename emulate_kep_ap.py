@@ -0,0 +1,332 @@
+"""
+Check the protocol KEP-AP on small pools without a three-party run.
+
+The program is compiled with the argument 'emulate' for the ring domain and run with the cleartext emulator emulate.x
+of MP-SPDZ. The emulated program reads the inputs of all pairs from Player-Data/Input-P0-0 and prints the exchange
+partners, so neither SSL certificates nor client processes are needed. The exchange partners are checked against a
+NumPy reference of the construction, evaluation, and optimization phases.
+
+The protocol shuffles the pairs before the greedy selection, so subsets of equal weight are chosen in a different
+order in every run and the result cannot be compared with a single run of the reference greedy. Instead, the checks
+hold for every order of ties: the exchange consists of disjoint cycles of compatible pairs, each cycle is a cycle of
+maximum weight of its subset, and every subset of positive weight that is not chosen shares a pair with a chosen
+subset of at least the same weight. A set of disjoint subsets is a possible result of the greedy selection if and only
+if it passes these checks.
+"""
+
+import argparse
+import itertools
+import os
+import re
+import subprocess
+import tempfile
+
+import numpy
+
+import generate_pool_kep_ap
+import run_kep_ap
+
+# constants of the prioritization, see smpc_protocols/Compiler/comp_gate.py
+W_ANTIGEN_BOUND = 2
+W_AGE_PATIENT_DONOR = 10
+W_AGE_DONOR_DONOR = 10
+NUM_REGIONS = 12
+REGION_MATRIX = numpy.array([[100 - abs(r1 - r2) * 25 if abs(r1 - r2) < 4 else 0 for r2 in range(NUM_REGIONS)]
+                             for r1 in range(NUM_REGIONS)])
+
+# number of values in each row of the input file (see README) and the rows of HLA indicator vectors
+HLA_LOCI = list(generate_pool_kep_ap.HLA_LOCI.values())
+PRIO_HLA_LOCI = [generate_pool_kep_ap.HLA_LOCI[locus] for locus in generate_pool_kep_ap.PRIO_HLA_LOCI]
+INPUT_ROW_LENGTHS = [4] + HLA_LOCI + [4] + HLA_LOCI + [1] + PRIO_HLA_LOCI + [1] * 6
+HLA_ROWS = list(range(1, 7)) + list(range(8, 14)) + list(range(15, 18))
+PACKED_WORD_BITS = 32
+
+EMULATOR = "../MPSPDZ/emulate.x"
+EMULATOR_INPUT = "smpc_protocols/Player-Data/Input-P0-0"
+OUTPUT_PATTERN = re.compile(r"^Pair (\d+): donor (\d+), recipient (\d+)", re.M)
+
+
+def read_input_file(path):
+    """
+    Rows of an input file with the HLA indicator vectors given either as 0/1 values or as packed hexadecimal words.
+    """
+    with open(path, "r") as file:
+        rows = [line.split() for line in file if line.strip()]
+    values = []
+    for tokens, length in zip(rows, INPUT_ROW_LENGTHS):
+        if tokens[0].startswith("0x"):
+            words = [int(token, 16) for token in tokens]
+            values.append([(words[k // PACKED_WORD_BITS] >> (k % PACKED_WORD_BITS)) & 1 for k in range(length)])
+        else:
+            values.append([int(token) for token in tokens])
+    if [len(row) for row in values] != INPUT_ROW_LENGTHS:
+        raise Exception("invalid input file " + path)
+    return values
+
+
+def input_vector(rows, packed=False):
+    """
+    Input vector of a pair in the order in which the clients send it.
+    """
+    if packed:
+        rows = [[sum(bit << k for k, bit in enumerate(row[w:w + PACKED_WORD_BITS]))
+                 for w in range(0, len(row), PACKED_WORD_BITS)] if i in HLA_ROWS else row
+                for i, row in enumerate(rows)]
+    return [value for row in rows for value in row]
+
+
+def pool_arrays(pairs):
+    """
+    Input of all pairs as arrays; pairs holds the rows of the input file of each pair.
+    """
+    def column(row):
+        return numpy.array([pair[row] for pair in pairs], dtype=numpy.int64)
+
+    def scalar(row):
+        return column(row)[:, 0]
+
+    donor_hla = numpy.concatenate([column(row) for row in range(1, 7)], axis=1)
+    starts = numpy.cumsum([0] + HLA_LOCI)
+    return {"donor_blood": column(0),
+            "donor_hla": donor_hla,
+            "patient_blood": column(7),
+            "antibodies": numpy.concatenate([column(row) for row in range(8, 14)], axis=1),
+            "prescore": scalar(14),
+            "patient_antigens": numpy.concatenate([column(row) for row in range(15, 18)], axis=1),
+            # A, B, and DR loci of the donor HLA
+            "donor_antigens": numpy.concatenate([donor_hla[:, starts[k]:starts[k + 1]] for k in (0, 1, 3)], axis=1),
+            "patient_bloodtype": scalar(18),
+            "donor_bloodtype": scalar(19),
+            "patient_age": scalar(20),
+            "donor_age": scalar(21),
+            "patient_region": scalar(22),
+            "donor_region": scalar(23)}
+
+
+def adjacency_matrix(pool):
+    """
+    Entry [i][j] indicates whether the donor of pair i can give to the patient of pair j (compute_comp_matrix).
+    """
+    blood = pool["donor_blood"] @ pool["patient_blood"].T > 0
+    crossmatch = pool["donor_hla"] @ pool["antibodies"].T < 1
+    return (blood & crossmatch).astype(numpy.int64)
+
+
+def prioritization_matrix(pool):
+    """
+    Entry [i][j] is the weight of the donation of the donor of pair i to the patient of pair j (compute_prio_matrix).
+    """
+    antigens = pool["donor_antigens"] @ pool["patient_antigens"].T < W_ANTIGEN_BOUND
+    bloodtypes = pool["donor_bloodtype"][:, None] == pool["patient_bloodtype"][None, :]
+    patient_donor = pool["patient_age"][None, :] - pool["donor_age"][:, None]
+    donor_donor = pool["donor_age"][None, :] - pool["donor_age"][:, None]
+    return (pool["prescore"][None, :] + antigens + bloodtypes + (-patient_donor ** 2 < W_AGE_PATIENT_DONOR) +
+            (-donor_donor ** 2 < W_AGE_DONOR_DONOR) +
+            REGION_MATRIX[pool["patient_region"][None, :], pool["donor_region"][:, None]])
+
+
+def subsets(n):
+    """
+    Nodes of all subsets of size 2 and 3 in the order of the protocol (by size, then colexicographically).
+    """
+    colex = lambda size: sorted(itertools.combinations(range(n), size), key=lambda nodes: nodes[::-1])
+    return colex(2) + colex(3)
+
+
+def cycle_weights(adjacency, prio, nodes):
+    """
+    Weight of each subset and the cycle of maximum weight on it (setup_phase). A subset {a < b < c} has the cycles
+    (a, b, c) and (a, c, b), and the first one is taken if both have the same weight.
+    """
+    weights, cycles = [], []
+    for subset in nodes:
+        if len(subset) == 2:
+            candidates = [subset]
+        else:
+            a, b, c = subset
+            candidates = [(a, b, c), (a, c, b)]
+        best, best_weight = None, -1
+        for cycle in candidates:
+            edges = list(zip(cycle, cycle[1:] + cycle[:1]))
+            weight = all(adjacency[u][v] for u, v in edges) * sum(int(prio[u][v]) for u, v in edges)
+            if weight > best_weight:
+                best, best_weight = cycle, weight
+        weights.append(best_weight)
+        cycles.append(best)
+    return numpy.array(weights), cycles
+
+
+def greedy(n, weights, nodes):
+    """
+    Indices of the subsets chosen by the optimization phase: n // 2 times, the first subset of maximum positive weight
+    is chosen and all subsets that share a pair with it are discarded.
+    """
+    weights = weights.copy()
+    chosen = []
+    for _ in range(n // 2):
+        index = int(numpy.argmax(weights))
+        if weights[index] <= 0:
+            break
+        chosen.append(index)
+        conflicts = [i for i, subset in enumerate(nodes) if set(subset) & set(nodes[index])]
+        weights[conflicts] = 0
+    return chosen
+
+
+def exchange(n, cycles):
+    """
+    Donor and recipient of each pair (1-based, 0 if none) for the given cycles (decryption_phase).
+    """
+    donors, recipients = [0] * n, [0] * n
+    for cycle in cycles:
+        for u, v in zip(cycle, cycle[1:] + cycle[:1]):
+            recipients[u] = v + 1
+            donors[v] = u + 1
+    return donors, recipients
+
+
+def check(adjacency, prio, donors, recipients):
+    """
+    List of violations of the checks described in the module documentation; an empty list means that the exchange is a
+    possible result of the protocol for the given matrices.
+    """
+    n = len(donors)
+    nodes = subsets(n)
+    weights, _ = cycle_weights(adjacency, prio, nodes)
+    index = {subset: i for i, subset in enumerate(nodes)}
+    errors = []
+
+    for i in range(n):
+        if recipients[i] and donors[recipients[i] - 1] != i + 1:
+            errors.append(f"recipient of pair {i + 1} is pair {recipients[i]}, whose donor is pair "
+                          f"{donors[recipients[i] - 1]}")
+        if donors[i] and recipients[donors[i] - 1] != i + 1:
+            errors.append(f"donor of pair {i + 1} is pair {donors[i]}, whose recipient is pair "
+                          f"{recipients[donors[i] - 1]}")
+    if errors:
+        return errors
+
+    # A pair that donates but does not receive starts a chain, which ends at a pair that does not donate.
+    chosen, seen = [], set()
+    for start in range(n):
+        if recipients[start] and not donors[start]:
+            chain = [start]
+            while recipients[chain[-1]]:
+                chain.append(recipients[chain[-1]] - 1)
+            seen.update(chain)
+            errors.append(f"open chain {[u + 1 for u in chain]}")
+    if errors:
+        return errors
+
+    for start in range(n):
+        if not recipients[start] or start in seen:
+            continue
+        cycle = [start]
+        while recipients[cycle[-1]] - 1 != start and len(cycle) <= n:
+            cycle.append(recipients[cycle[-1]] - 1)
+        seen.update(cycle)
+        subset = tuple(sorted(cycle))
+        edges = list(zip(cycle, cycle[1:] + cycle[:1]))
+        weight = sum(int(prio[u][v]) for u, v in edges)
+        if subset not in index:
+            errors.append(f"cycle {[u + 1 for u in cycle]} does not have 2 or 3 pairs")
+        elif not all(adjacency[u][v] for u, v in edges):
+            errors.append(f"cycle {[u + 1 for u in cycle]} contains an incompatible donation")
+        elif weight != weights[index[subset]] or weight <= 0:
+            errors.append(f"cycle {[u + 1 for u in cycle]} has weight {weight}, but the best cycle on its pairs has "
+                          f"weight {weights[index[subset]]}")
+        else:
+            chosen.append(index[subset])
+
+    for i, subset in enumerate(nodes):
+        if weights[i] <= 0 or i in chosen:
+            continue
+        if not any(set(subset) & set(nodes[j]) and weights[j] >= weights[i] for j in chosen):
+            errors.append(f"subset {[u + 1 for u in subset]} of weight {weights[i]} was left out although it does not "
+                          f"conflict with a chosen subset of at least the same weight")
+    return errors
+
+
+def reference(pool):
+    """
+    Adjacency matrix, prioritization matrix, and the exchange partners found by the reference greedy.
+    """
+    adjacency, prio = adjacency_matrix(pool), prioritization_matrix(pool)
+    n = len(adjacency)
+    nodes = subsets(n)
+    weights, cycles = cycle_weights(adjacency, prio, nodes)
+    donors, recipients = exchange(n, [cycles[i] for i in greedy(n, weights, nodes)])
+    return adjacency, prio, donors, recipients
+
+
+def emulate(program, pairs, packed):
+    """
+    Run the compiled program with emulate.x on the given pairs and return the donors and recipients it prints.
+    """
+    os.makedirs(os.path.dirname(EMULATOR_INPUT), exist_ok=True)
+    with open(EMULATOR_INPUT, "w") as file:
+        file.write(" ".join(str(value) for rows in pairs for value in input_vector(rows, packed)) + "\n")
+    output = subprocess.run([EMULATOR, program], cwd="./smpc_protocols", stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True, check=True).stdout
+    rows = sorted((int(pair), int(donor), int(recipient)) for pair, donor, recipient in OUTPUT_PATTERN.findall(output))
+    if [pair for pair, _, _ in rows] != list(range(1, len(pairs) + 1)):
+        raise Exception("the emulator did not print the exchange partners of all pairs:\n" + output)
+    return [donor for _, donor, _ in rows], [recipient for _, _, recipient in rows]
+
+
+def pools(args):
+    """
+    Rows of the input files of each pool to check: the input files under smpc_protocols/Inputs, or random pools from
+    the synthetic pool generator.
+    """
+    if not args.pools:
+        run_kep_ap.generate_random_input(args.pairs)
+        yield "smpc_protocols/Inputs", [read_input_file(os.path.join(generate_pool_kep_ap.INPUT_DIR, f"input_{i}.txt"))
+                                        for i in range(args.pairs)]
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(args.seed, args.seed + args.pools):
+            pool = generate_pool_kep_ap.generate_pool(args.pairs, seed=seed, sensitization=args.sensitization)
+            generate_pool_kep_ap.write_pool(pool, directory)
+            yield f"seed {seed}", [read_input_file(os.path.join(directory, f"input_{i}.txt"))
+                                   for i in range(args.pairs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check KEP-AP in the cleartext emulator against a NumPy reference.")
+    parser.add_argument("pairs", type=int, help="number of patient-donor pairs")
+    parser.add_argument("--pools", type=int, default=0,
+                        help="check this many random pools instead of the input files under smpc_protocols/Inputs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first random pool")
+    parser.add_argument("--sensitization", type=float, default=0.0,
+                        help="sensitization dial of the random pools (see generate_pool_kep_ap.py)")
+    parser.add_argument("--packed", action="store_true", help="emulate the program for the packed input encoding")
+    parser.add_argument("--reference-only", action="store_true",
+                        help="only check the reference greedy, without MP-SPDZ")
+    args = parser.parse_args()
+
+    if not args.reference_only:
+        program = "-".join(run_kep_ap.program_args(args.pairs, args.packed, ring=True, emulate=True))
+        run_kep_ap.sync_sources()
+        run_kep_ap.compile_code(args.pairs, args.packed, ring=True, emulate=True)
+
+    failures = 0
+    for name, pairs in pools(args):
+        adjacency, prio, donors, recipients = reference(pool_arrays(pairs))
+        errors = check(adjacency, prio, donors, recipients)
+        if not args.reference_only:
+            donors, recipients = emulate(program, pairs, args.packed)
+            errors += check(adjacency, prio, donors, recipients)
+        failures += bool(errors)
+        matched = sum(recipient > 0 for recipient in recipients)
+        print(f"{name}: {'FAILED' if errors else 'ok'} ({matched} of {args.pairs} pairs matched)")
+        for error in errors:
+            print(f"{run_kep_ap.OUTPUT_COLORS[3]}  {error}{run_kep_ap.END_COLOR}")
+
+    if failures:
+        raise SystemExit(f"{failures} pools failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+Generate a synthetic pool of patient-donor pairs as input files for the protocol KEP-AP.
+
+The blood types, the HLA antigens of patients and donors (two alleles per locus), the antibodies of the patients, the
+ages, the regions, and the pre-scores are drawn from frequency tables (see DEFAULT_TABLES; any subset of the tables can
+be replaced by a JSON file). The antibodies of a patient are drawn to match a calculated panel reactive antibody level
+(cPRA), i.e., the probability that a random donor of the population carries an antigen against which the patient has
+antibodies. The cPRA levels are drawn from the table of PRA classes and can be shifted with the sensitization dial, or
+the dial can be calibrated to reach a target density of the compatibility graph.
+
+All draws are made with NumPy for the whole pool at once and seeded, so the same arguments always produce the same pool.
+"""
+
+import argparse
+import json
+import os
+
+import numpy
+
+# number of antigens per HLA locus, in the order of the input files (see README)
+HLA_LOCI = {"A": 59, "B": 132, "C": 48, "DR": 61, "DQ": 26, "DP": 22}
+# loci of the patient HLA indicator vectors used for the prioritization
+PRIO_HLA_LOCI = ["A", "B", "DR"]
+ANTIGEN_TYPES = sum(HLA_LOCI.values())
+
+# blood types are numbered O, B, A, AB as in rows 19-20 of the input files (minus 1); a donor indicator marks all
+# blood types of patients the donor can give to, a patient indicator marks the blood type of the patient
+DONOR_BLOOD_INDICATORS = numpy.array([[1, 1, 1, 1], [0, 1, 0, 1], [0, 0, 1, 1], [0, 0, 0, 1]], dtype=numpy.uint8)
+PATIENT_BLOOD_INDICATORS = numpy.eye(4, dtype=numpy.uint8)
+
+# Frequency tables of the population. The antigen frequencies of a locus default to a Zipf distribution with the given
+# exponent over the antigens of the locus and can be given explicitly per locus. A PRA class [low, high, probability]
+# gives the probability that the cPRA of a patient is uniform in [low, high].
+DEFAULT_TABLES = {
+    "blood_types": [0.44, 0.10, 0.42, 0.04],
+    "antigens": {},
+    "zipf_exponent": 1.0,
+    "pra_classes": [[0.0, 0.0, 0.55], [0.01, 0.5, 0.2], [0.5, 0.85, 0.1], [0.85, 0.99, 0.15]],
+    "patient_age": [18, 75],
+    "donor_age": [18, 70],
+    "regions": [1] * 12,
+    "prescore": [0, 200],
+}
+
+INPUT_DIR = "smpc_protocols/Inputs"
+
+
+def load_tables(path=None):
+    tables = dict(DEFAULT_TABLES)
+    if path:
+        with open(path, "r") as file:
+            tables.update(json.load(file))
+    return tables
+
+
+def normalize(weights):
+    weights = numpy.asarray(weights, dtype=float)
+    return weights / weights.sum()
+
+
+def antigen_frequencies(tables):
+    """
+    Frequency of each antigen within its locus, concatenated over all loci in the order of HLA_LOCI.
+    """
+    frequencies = []
+    for locus, size in HLA_LOCI.items():
+        if locus in tables["antigens"]:
+            frequencies.append(normalize(tables["antigens"][locus]))
+        else:
+            frequencies.append(normalize(1 / numpy.arange(1, size + 1) ** tables["zipf_exponent"]))
+    return numpy.concatenate(frequencies)
+
+
+def draw_hla(rng, n, frequencies):
+    """
+    Indicator matrix of the antigens of n people with two alleles drawn per locus.
+    """
+    hla = numpy.zeros((n, ANTIGEN_TYPES), dtype=numpy.uint8)
+    offset = 0
+    for size in HLA_LOCI.values():
+        alleles = rng.choice(size, size=(n, 2), p=frequencies[offset:offset + size])
+        hla[numpy.arange(n)[:, None], offset + alleles] = 1
+        offset += size
+    return hla
+
+
+def draw_population(n, tables, rng):
+    """
+    Everything but the antibodies of n patient-donor pairs. The patient and the donor of a pair live in the same
+    region.
+    """
+    frequencies = antigen_frequencies(tables)
+    classes = numpy.asarray(tables["pra_classes"], dtype=float)
+    pra_class = rng.choice(len(classes), size=n, p=normalize(classes[:, 2]))
+    region = rng.choice(len(tables["regions"]), size=n, p=normalize(tables["regions"]))
+    return {
+        "patient_blood": rng.choice(4, size=n, p=normalize(tables["blood_types"])),
+        "donor_blood": rng.choice(4, size=n, p=normalize(tables["blood_types"])),
+        "patient_hla": draw_hla(rng, n, frequencies),
+        "donor_hla": draw_hla(rng, n, frequencies),
+        "pra": rng.uniform(classes[pra_class, 0], classes[pra_class, 1]),
+        # order in which antibodies are acquired; antigens of the patient itself come last and are never used
+        "antibody_keys": rng.random((n, ANTIGEN_TYPES)),
+        "patient_age": rng.integers(tables["patient_age"][0], tables["patient_age"][1], size=n, endpoint=True),
+        "donor_age": rng.integers(tables["donor_age"][0], tables["donor_age"][1], size=n, endpoint=True),
+        "patient_region": region,
+        "donor_region": region,
+        "prescore": rng.integers(tables["prescore"][0], tables["prescore"][1], size=n, endpoint=True),
+        "frequencies": frequencies,
+    }
+
+
+def sensitize(pra, sensitization):
+    """
+    Shift the cPRA levels by the sensitization dial in [-1, 1]: positive values move them towards 1 (sparser graphs),
+    negative values towards 0 (denser graphs); -1 removes all antibodies.
+    """
+    if sensitization >= 0:
+        return pra + sensitization * (1 - pra)
+    return pra * (1 + sensitization)
+
+
+def assign_antibodies(population, sensitization=0.0):
+    """
+    Give each patient antibodies against the antigens in the order of its keys until its cPRA reaches the target. The
+    cPRA of a set of antibodies is 1 - prod over the loci of (1 - summed frequency of the antigens of the locus)^2.
+    """
+    n = len(population["pra"])
+    frequencies = population["frequencies"]
+    own = population["patient_hla"].astype(bool)
+    order = numpy.argsort(numpy.where(own, 2.0, population["antibody_keys"]), axis=1)
+    sorted_frequencies = frequencies[order]
+
+    log_survival = numpy.zeros((n, ANTIGEN_TYPES))
+    offset = 0
+    for size in HLA_LOCI.values():
+        in_locus = (order >= offset) & (order < offset + size)
+        covered = numpy.cumsum(sorted_frequencies * in_locus, axis=1)
+        log_survival += 2 * numpy.log(numpy.clip(1 - covered, 1e-12, None))
+        offset += size
+    cpra = 1 - numpy.exp(log_survival)
+
+    target = sensitize(population["pra"], sensitization)
+    count = numpy.where(target > 0, (cpra < target[:, None]).sum(axis=1) + 1, 0)
+    count = numpy.minimum(count, ANTIGEN_TYPES - own.sum(axis=1))
+
+    antibodies = numpy.zeros((n, ANTIGEN_TYPES), dtype=numpy.uint8)
+    numpy.put_along_axis(antibodies, order, numpy.arange(ANTIGEN_TYPES)[None, :] < count[:, None], axis=1)
+    pool = dict(population)
+    pool["antibodies"] = antibodies
+    return pool
+
+
+def compatibility_matrix(pool):
+    """
+    Entry [i][j] indicates whether the donor of pair i can give to the patient of pair j, as computed by the protocol.
+    """
+    blood = DONOR_BLOOD_INDICATORS[pool["donor_blood"]] @ PATIENT_BLOOD_INDICATORS[pool["patient_blood"]].T > 0
+    crossmatch = pool["donor_hla"].astype(numpy.int32) @ pool["antibodies"].T.astype(numpy.int32) == 0
+    compatible = blood & crossmatch
+    numpy.fill_diagonal(compatible, False)
+    return compatible
+
+
+def density(pool):
+    n = len(pool["pra"])
+    return compatibility_matrix(pool).sum() / max(n * (n - 1), 1)
+
+
+def generate_pool(n, tables=None, seed=None, sensitization=0.0):
+    return assign_antibodies(draw_population(n, tables or DEFAULT_TABLES, numpy.random.default_rng(seed)),
+                             sensitization)
+
+
+def calibrate(population, target_density, iterations=20):
+    """
+    Sensitization dial for which the density of the compatibility graph is closest to the target, found by bisection.
+    The population is fixed, so the density only decreases with the dial.
+    """
+    low, high = -1.0, 1.0
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        if density(assign_antibodies(population, middle)) > target_density:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def indicator_lines(indicators, fields):
+    """
+    Rows of the input file for the (start, stop) column ranges of a 0/1 matrix, concatenated per pair. The digits and
+    separators of all pairs are written into a single byte array.
+    """
+    blocks = []
+    for start, stop in fields:
+        block = numpy.full((len(indicators), 2 * (stop - start)), ord(" "), dtype=numpy.uint8)
+        block[:, 0::2] = indicators[:, start:stop] + ord("0")
+        block[:, -1] = ord("\n")
+        blocks.append(block)
+    return [row.tobytes() for row in numpy.concatenate(blocks, axis=1)]
+
+
+def locus_fields(loci):
+    starts = dict(zip(HLA_LOCI, numpy.cumsum([0] + list(HLA_LOCI.values()))))
+    return [(starts[locus], starts[locus] + HLA_LOCI[locus]) for locus in loci]
+
+
+def write_pool(pool, directory=INPUT_DIR, pairs=None):
+    """
+    Write the input file of each given pair (default: all pairs) in the format described in the README.
+    """
+    pairs = range(len(pool["pra"])) if pairs is None else pairs
+    donor_blood = indicator_lines(DONOR_BLOOD_INDICATORS[pool["donor_blood"]], [(0, 4)])
+    patient_blood = indicator_lines(PATIENT_BLOOD_INDICATORS[pool["patient_blood"]], [(0, 4)])
+    donor_hla = indicator_lines(pool["donor_hla"], locus_fields(HLA_LOCI))
+    antibodies = indicator_lines(pool["antibodies"], locus_fields(HLA_LOCI))
+    patient_hla = indicator_lines(pool["patient_hla"], locus_fields(PRIO_HLA_LOCI))
+    scalars = numpy.stack([pool["patient_blood"] + 1, pool["donor_blood"] + 1, pool["patient_age"],
+                           pool["donor_age"], pool["patient_region"], pool["donor_region"]], axis=1)
+
+    os.makedirs(directory, exist_ok=True)
+    for i in pairs:
+        with open(os.path.join(directory, f"input_{i}.txt"), "wb") as file:
+            file.write(donor_blood[i] + donor_hla[i] + patient_blood[i] + antibodies[i] +
+                       f"{pool['prescore'][i]}\n".encode() + patient_hla[i] +
+                       "".join(f"{value}\n" for value in scalars[i]).encode())
+
+
+def report(pool):
+    compatible = compatibility_matrix(pool)
+    n = len(pool["pra"])
+    blood = assign_antibodies(pool, -1.0)
+    return {"pairs": n,
+            "density": density(pool),
+            "blood_type_density": density(blood),
+            "mean_antibodies": float(pool["antibodies"].sum(axis=1).mean()),
+            "highly_sensitized": float((1 - compatible.sum(axis=0) / max(n - 1, 1) >= 0.85).mean()),
+            "without_donor": int((compatible.sum(axis=0) == 0).sum()),
+            "without_recipient": int((compatible.sum(axis=1) == 0).sum())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic pool of patient-donor pairs for KEP-AP.")
+    parser.add_argument("pairs", type=int, help="number of patient-donor pairs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random number generator")
+    parser.add_argument("--tables", help="JSON file that replaces entries of the default frequency tables")
+    dial = parser.add_mutually_exclusive_group()
+    dial.add_argument("--sensitization", type=float, default=0.0,
+                      help="shift of the cPRA levels in [-1, 1]; larger values give sparser compatibility graphs")
+    dial.add_argument("--density", type=float, help="calibrate the sensitization to this compatibility graph density")
+    parser.add_argument("--output-dir", default=INPUT_DIR, help="directory of the input files")
+    parser.add_argument("--dry-run", action="store_true", help="only report the density, do not write input files")
+    args = parser.parse_args()
+
+    population = draw_population(args.pairs, load_tables(args.tables), numpy.random.default_rng(args.seed))
+    sensitization = args.sensitization if args.density is None else calibrate(population, args.density)
+    pool = assign_antibodies(population, sensitization)
+
+    print(f"sensitization: {sensitization:.4f}")
+    for key, value in report(pool).items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+    if not args.dry_run:
+        write_pool(pool, args.output_dir)
+        print(f"Wrote {args.pairs} input files to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
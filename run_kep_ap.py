@@ -1,14 +1,57 @@
+import argparse
+import csv
+import json
+import math
 import os
+import re
+import socket
 import subprocess
 import shutil
-import re
-import random
-import sys
+import hashlib
+
+import generate_pool_kep_ap
 
 COMPUTING_PEERS = 3
 PROTOCOL = "replicated-field-party.x"
+# default protocol of each computation domain; ring protocols are recognized by 'ring' in the name of their binary
+PROTOCOLS = {"field": PROTOCOL, "ring": "replicated-ring-party.x"}
+RING_BITS = 64
 PROGRAM = "KEP_AP"
 BATCHSIZE = "10000"
+COMPILER_FLAGS = []
+
+# protocol and batch size per pool size found by tune_kep_ap.py, one file per host
+PROFILE_DIR = "profiles"
+
+# Preprocessing material for the online mode is generated by the MP-SPDZ dealer Fake-Offline.x with a safety margin on
+# the amounts required by the compiled program. EDABIT_LENGTHS are generated unless the compiler reports the lengths.
+PREPROCESSING_MANIFEST = "smpc_protocols/Player-Data/Preprocessing.json"
+PREPROCESSING_MARGIN = 1.1
+FIELD_BITS = 128
+EDABIT_LENGTHS = [2, 4, 32, 64]
+# options of Fake-Offline.x for the amount of a type of material, by a word of the description in the compiler
+# statistics; all other types, including edaBits of all lengths, are generated in the amount of --default
+PREPROCESSING_OPTIONS = {"triples": "--ntriples", "bits": "--nbits", "squares": "--nsquares", "inputs": "--ninputs"}
+
+# In the incremental mode, each computing peer keeps the inputs and the matrices of the last round in its persistent
+# storage. The manifest records the program of the last round and the pairs that have left the pool since.
+PERSISTENCE_DIR = "smpc_protocols/Persistence"
+STATE_MANIFEST = os.path.join(PERSISTENCE_DIR, "State.json")
+PUBLIC_INPUT_DIR = "smpc_protocols/Programs/Public-Input"
+# status of a pair in a round of the incremental mode, see STATUS_* in smpc_protocols/Compiler/comp_gate.py
+STATUS_UNCHANGED = 0
+STATUS_CHANGED = 1
+STATUS_DEPARTED = 2
+
+STATISTIC_PATTERN = re.compile(r"^\s+(\d+(?:\.\d+)?(?:e\+?\d+)?)\s+(.+?)\s*$")
+EDABIT_LENGTH_PATTERN = re.compile(r"edabits? of (?:length|size) (\d+)", re.I)
+MEMORY_PATTERN = re.compile(r"^Memory size of (\w+): (\d+)", re.M)
+
+# compiled programs are cached per combination of compile.py arguments, compiler flags, and the sources below
+CACHE_DIR = "smpc_protocols/Programs/Cache"
+CACHE_SOURCES = ["smpc_protocols/Programs/Source/KEP_AP.mpc",
+                 "smpc_protocols/Compiler/comp_gate.py",
+                 "smpc_protocols/Compiler/networking.py"]
 
 WARNING_COLOR = "\033[92m"
 END_COLOR = "\033[0m"
@@ -25,188 +68,559 @@ def execute(cmd, currwd, prnt):
 
     popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=currwd, universal_newlines=True)
 
+    output = []
     for line in popen.stdout:
         print(line, end='')
+        output.append(line)
 
     popen.stdout.close()
     return_code = popen.wait()
 
     if return_code:
         raise subprocess.CalledProcessError(return_code, cmd)
+    return "".join(output)
+
+
+def generate_random_input(input_peers, seed=None):
+    """
+    Create synthetic example inputs (see generate_pool_kep_ap.py) for those input peers for which no input data is
+    specified under 'smpc_protocols/Inputs'.
+    """
+    missing = [i for i in range(input_peers)
+               if not os.path.isfile(os.path.join(generate_pool_kep_ap.INPUT_DIR, f"input_{i}.txt"))]
+    if not missing:
+        return
+    print(f"Generating synthetic input for {len(missing)} clients")
+    pool = generate_pool_kep_ap.generate_pool(input_peers, seed=seed)
+    generate_pool_kep_ap.write_pool(pool, generate_pool_kep_ap.INPUT_DIR, missing)
+
 
+def program_args(clients, packed=False, ring=False, threads=1, incremental=False, emulate=False, top_k=1, until=None):
+    """
+    Arguments for compile.py. MP-SPDZ names the compiled program after these arguments, joined by '-'. The argument
+    'ring' only keeps the names of programs compiled for the ring domain apart. With until, the program ends after the
+    phase of the given timer, which is only used to compile the program for the statistics of a phase.
+    """
+    args = [PROGRAM, str(clients)]
+    if packed:
+        args.append("packed")
+    if ring:
+        args.append("ring")
+    if threads > 1:
+        args.append(f"threads={threads}")
+    if incremental:
+        args.append("incremental")
+    if emulate:
+        args.append("emulate")
+    if top_k > 1:
+        args.append(f"topk={top_k}")
+    if until is not None:
+        args.append(f"until={until}")
+    return args
+
+
+def compiler_flags(ring=False):
+    return COMPILER_FLAGS + (["-R", str(RING_BITS)] if ring else [])
 
-def generate_random_input(input_peers):
+
+def is_ring(protocol):
+    return "ring" in protocol
+
+
+def compile_cache_key(args, flags):
     """
-    Create random example inputs for those input peers for which no input data is specified under 'protocols/Inputs'.
+    Hash of the compile.py arguments (which include the number of patient-donor pairs), the compiler flags, and the
+    sources of the program.
     """
+    digest = hashlib.sha256(" ".join(flags + args).encode())
+    for source in CACHE_SOURCES:
+        with open(source, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
 
-    for i in range(input_peers):
-        f_name = f"smpc_protocols/Inputs/input_{i}.txt"
-        if os.path.isfile(f_name):
+def parse_program_statistics(output):
+    """
+    Statistics listed by the compiler after 'Program requires', e.g., '1234 integer triples', as a dictionary from
+    description to count.
+    """
+    statistics = {}
+    listing = False
+    for line in output.splitlines():
+        if line.startswith("Program requires"):
+            listing = True
             continue
-        print("Generating random input for client "+str(i))
-        with open(f_name, "w") as file:
-            # meaning: Bloodtype indicator, HLA-A, -B, -C, -DR, -DQ, -DP
-            input_lengths = [4, 59, 132, 48, 61, 26, 22]
-            donor_blood_type = random.randint(0, 3)
-            patient_blood_type = random.randint(0, 3)
-            for k in input_lengths:
-                if k == 4:
-                    if donor_blood_type == 0:
-                        donor_bloodtype_indicator = "1 1 1 1\n"
-                    elif donor_blood_type == 1:
-                        donor_bloodtype_indicator = "0 1 0 1\n"
-                    elif donor_blood_type == 2:
-                        donor_bloodtype_indicator = "0 0 1 1\n"
-                    else:
-                        donor_bloodtype_indicator = "0 0 0 1\n"
-                    file.write(donor_bloodtype_indicator)
-                else:
-                    for j in range(k-1):
-                        file.write("0 ")
-                    file.write("0\n")
-
-            for k in input_lengths:
-                if k == 4:
-                    if patient_blood_type == 0:
-                        patient_bloodtype_indicator = "1 0 0 0\n"
-                    elif patient_blood_type == 1:
-                        patient_bloodtype_indicator = "0 1 0 1\n"
-                    elif patient_blood_type == 2:
-                        patient_bloodtype_indicator = "0 0 1 1\n"
-                    else:
-                        patient_bloodtype_indicator = "1 1 1 1\n"
-                    file.write(patient_bloodtype_indicator)
-                else:
-                    for j in range(k-1):
-                        file.write("0 ")
-                    file.write("0\n")
-
-            # add random pre-score
-            file.write(str(random.randint(0, 200))+"\n")
-            prio_input_lengths = [59, 132, 61]
-            for k in prio_input_lengths:
-                for j in range(k-1):
-                    file.write("0 ")
-                file.write("0\n")
-            # add patient and donor blood type
-            file.write(str(patient_blood_type+1)+"\n")
-            file.write(str(donor_blood_type+1) + "\n")
-            # add random patient and donor age
-            file.write(str(random.randint(10, 100)) + "\n")
-            file.write(str(random.randint(10, 100)) + "\n")
-            # add random patient and donor region
-            region = random.randint(0, 11)
-            file.write(str(region) + "\n")
-            file.write(str(region) + "\n")
-
-
-def compile_code(clients):
-    # modify the mpc files for the current number of clients
-    with open("smpc_protocols/Programs/Source/KEP_AP.mpc", "r") as file:
-        text = file.read()
-
-    text = re.sub(r"NUM_NODES = \d+", f"NUM_NODES = {clients}", text)
-    s_len_two = int(clients * (clients - 1) / 2)
-    s_len_three = int(clients * (clients - 1) * (clients - 2) / 6)
-    text = re.sub(r"S_LENGTH = \d+", f"S_LENGTH = {s_len_two + s_len_three}", text)
-    text = re.sub(r"S_LENGTH_TWO = \d+", f"S_LENGTH_TWO = {s_len_two}", text)
-    text = re.sub(r"S_LENGTH_THREE = \d+", f"S_LENGTH_THREE = {s_len_three}", text)
-
-    with open("smpc_protocols/Programs/Source/KEP_AP.mpc", "w+") as file:
-        file.write(text)
-
-    # copy the inputs of the patient-donor pairs to the MP-SPDZ directory
-    try:
-        execute(["rm", "-r", "./ExternalIO/Inputs/"], "./MPSPDZ/", "\n\nRemoving old Input Data")
-    except subprocess.CalledProcessError:
-        line = "No old Input Data available.\n\n"
-        print(f"{WARNING_COLOR}{line}{END_COLOR}", end='')
+        match = STATISTIC_PATTERN.match(line) if listing else None
+        if match:
+            statistics[match.group(2)] = statistics.get(match.group(2), 0) + float(match.group(1))
+        else:
+            listing = False
+    return statistics
+
+
+def parse_memory_sizes(output):
+    """
+    Memory sizes printed by the compiler, e.g., 'Memory size of s: 1234', as a dictionary from memory type (s: secret,
+    c: clear, ci: clear integer, ...) to the number of memory cells.
+    """
+    return {memory: int(size) for memory, size in MEMORY_PATTERN.findall(output)}
+
+
+def requirements_path(program):
+    """
+    Statistics of the compiler for a compiled program, stored next to its schedule.
+    """
+    return f"smpc_protocols/Programs/Schedules/{program}.requirements.json"
+
+
+def store_requirements(program, output):
+    with open(requirements_path(program), "w") as file:
+        json.dump(parse_program_statistics(output), file, indent=2)
 
-    execute(["cp", "-r", "../smpc_protocols/Inputs/", "./ExternalIO/"], "./MPSPDZ/", "\n\nCopying Input Data")
 
-    # copy the custom code to the MP-SPDZ directory
+def compiled_files(program):
+    """
+    Paths of the schedule, of the compiler statistics, and of the bytecode of all tapes of a compiled program relative
+    to 'smpc_protocols/Programs'.
+    """
+    schedule = f"Schedules/{program}.sch"
+    with open(f"smpc_protocols/Programs/{schedule}", "r") as file:
+        tapes = file.read().splitlines()[2].split()
+    return [schedule, f"Schedules/{program}.requirements.json"] + \
+           [f"Bytecode/{tape.split(':')[0]}.bc" for tape in tapes]
+
+
+def restore_from_cache(key):
+    cached = os.path.join(CACHE_DIR, key)
+    if not os.path.isdir(cached):
+        return False
+
+    for root, _, files in os.walk(cached):
+        for name in files:
+            target = os.path.join("smpc_protocols/Programs", os.path.relpath(os.path.join(root, name), cached))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy(os.path.join(root, name), target)
+    return True
+
+
+def store_in_cache(key, program):
+    cached = os.path.join(CACHE_DIR, key)
+    for path in compiled_files(program):
+        target = os.path.join(cached, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy(os.path.join("smpc_protocols/Programs", path), target)
+
+
+def file_hash(path):
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def sync_file(source, target):
+    """
+    Copy source to target unless target already has the same content. Returns whether the file was copied.
+    """
+    if os.path.isfile(target) and file_hash(source) == file_hash(target):
+        return False
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copy(source, target)
+    return True
+
+
+def sync_tree(source, target, delete=True):
+    """
+    Copy all files of the directory source whose content differs from target. If delete is set, files in target that do
+    not exist in source are removed. Returns the number of copied files.
+    """
+    copied = 0
+    expected = set()
+    for root, _, files in os.walk(source):
+        for name in files:
+            relpath = os.path.relpath(os.path.join(root, name), source)
+            expected.add(relpath)
+            copied += sync_file(os.path.join(source, relpath), os.path.join(target, relpath))
+
+    if delete:
+        for root, _, files in os.walk(target):
+            for name in files:
+                if os.path.relpath(os.path.join(root, name), target) not in expected:
+                    os.remove(os.path.join(root, name))
+    return copied
+
+
+def setup_certificates(clients, protocol=PROTOCOL):
+    """
+    Generate SSL certificates for the computing peers and the patient-donor pairs. Existing certificates are reused; for
+    the patient-donor pairs, certificates are only generated for new client IDs.
+    """
+    if not os.path.isfile("./MPSPDZ/" + protocol):
+        execute(["./Scripts/tldr.sh"], "./MPSPDZ/", "\n\nExecuting 'tldr.sh'")
+
+    def missing(prefix, count):
+        return [i for i in range(count)
+                if not all(os.path.isfile(f"./MPSPDZ/Player-Data/{prefix}{i}.{ext}") for ext in ("pem", "key"))]
+
+    if missing("P", COMPUTING_PEERS):
+        execute(["./Scripts/setup-ssl.sh", str(COMPUTING_PEERS)], "./MPSPDZ/", "\n\nExecuting 'setup-ssl.sh'")
+
+    new_clients = missing("C", clients)
+    if new_clients:
+        print(f"\n\nGenerating certificates for {len(new_clients)} new clients")
+        for i in new_clients:
+            subprocess.run(["openssl", "req", "-newkey", "rsa", "-nodes", "-x509", "-out", f"Player-Data/C{i}.pem",
+                            "-keyout", f"Player-Data/C{i}.key", "-subj", f"/CN=C{i}"],
+                           cwd="./MPSPDZ/", check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        execute(["c_rehash", "Player-Data"], "./MPSPDZ/", "\n\nExecuting 'c_rehash Player-Data'")
+
+
+def sync_sources(inputs=True):
+    # copy the custom code and, with inputs, the inputs of the patient-donor pairs to the MP-SPDZ directory
+    copied = 0
     with open("smpc_protocols/deltas.txt", "r") as deltas:
         for line in deltas:
             target = line.split(">")
             target = [elem.strip() for elem in target]
-            try:
-                if os.path.exists(target[1]):
-                    shutil.rmtree(target[1])
-                shutil.copytree(target[0], target[1])
-            except NotADirectoryError:
-                shutil.copy(target[0], target[1])
-
-    # Cleanup the old player data
-    try:
-        execute(["rm", "-r", "./Player-Data/", "../smpc_protocols/Player-Data/"], "./MPSPDZ/", "\n\nRemoving old Player Data")
-    except subprocess.CalledProcessError:
-        line = "No old Player Data available.\n\n"
-        print(f"{WARNING_COLOR}{line}{END_COLOR}", end='')
+            if not inputs and os.path.normpath(target[0]) == os.path.normpath(generate_pool_kep_ap.INPUT_DIR):
+                continue
+            if os.path.isdir(target[0]):
+                copied += sync_tree(target[0], target[1])
+            else:
+                copied += sync_file(target[0], target[1])
+    print(f"\n\nCopied {copied} changed files to the MP-SPDZ directory")
 
-    # run the setup scripts for the computing peers and the patient-donor pairs
-    try:
-        execute(["./Scripts/tldr.sh"], "./MPSPDZ/", "\n\nExecuting 'tldr.sh'")
-        execute(["./Scripts/setup-ssl.sh", str(COMPUTING_PEERS)], "./MPSPDZ/", "\n\nExecuting 'setup-ssl.sh'")
-        execute(["./Scripts/setup-clients.sh", str(clients)], "./MPSPDZ/", "\n\nExecuting 'setup-clients.sh'")
 
+def setup(clients, protocol=PROTOCOL):
+    """
+    Prepare the MP-SPDZ directory for a run. Only files whose content changed since the last run are copied and SSL
+    certificates are only generated if they do not exist yet.
+    """
+    sync_sources()
+
+    # run the setup for the computing peers and the patient-donor pairs
+    try:
+        setup_certificates(clients, protocol)
     except subprocess.CalledProcessError:
         line = "MPSPDZ setup scripts returned exit status 1. If this is your first compilation run please abort and fix here.\n\n"
         print(f"{WARNING_COLOR}{line}{END_COLOR}", end='')
 
-    # compile the MP-SPDZ program KEP_AP
-    execute(["../MPSPDZ/compile.py", "KEP_AP"], "./smpc_protocols", "\n\nExecuting /MPSPDZ/compile.py KEP_AP")
+    # the computing peers run in smpc_protocols and need the certificates as well
+    copied = 0
+    for name in sorted(os.listdir("./MPSPDZ/Player-Data/")) if os.path.isdir("./MPSPDZ/Player-Data/") else []:
+        if os.path.isfile(os.path.join("./MPSPDZ/Player-Data/", name)):
+            copied += sync_file(os.path.join("./MPSPDZ/Player-Data/", name), os.path.join("./smpc_protocols/Player-Data/", name))
+    print(f"Copied {copied} changed files to smpc_protocols/Player-Data")
+
+
+def compile_code(clients, packed=False, use_cache=True, ring=False, threads=1, incremental=False, emulate=False,
+                 top_k=1):
+    # compile the MP-SPDZ program KEP_AP unless it has already been compiled for the same arguments and sources
+    args = program_args(clients, packed, ring, threads, incremental, emulate, top_k)
+    flags = compiler_flags(ring)
+    key = compile_cache_key(args, flags)
+    if use_cache and restore_from_cache(key):
+        print("\n\nUsing cached compilation of " + " ".join(args))
+    else:
+        output = execute(["../MPSPDZ/compile.py"] + flags + args, "./smpc_protocols",
+                         "\n\nExecuting /MPSPDZ/compile.py " + " ".join(flags + args))
+        store_requirements("-".join(args), output)
+        store_in_cache(key, "-".join(args))
 
-    execute(["cp", "-r", "../MPSPDZ/Player-Data/", "."], "./smpc_protocols", "\n\nCopying Player Data to smpc_protocols")
 
+def preprocessing_option(description):
+    return next((option for word, option in PREPROCESSING_OPTIONS.items() if word in description.split()),
+                "--default")
 
-def run(clients):
-    # start all computing peers
-    popen_first = subprocess.Popen(
-        ["../MPSPDZ/" + str(PROTOCOL), "-b", BATCHSIZE, "-h",
-         "localhost", "0", PROGRAM],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd="./smpc_protocols", universal_newlines=True)
 
-    for i in range(1, COMPUTING_PEERS):
-        subprocess.Popen(
-            ["../MPSPDZ/" + str(PROTOCOL), "-b", BATCHSIZE, "-h",
-             "localhost", str(i),
-             PROGRAM], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd="./smpc_protocols", universal_newlines=True)
+def preprocessing_amounts(requirements):
+    """
+    Amount of material per option of Fake-Offline.x: the largest amount required by the program among the types of
+    material of the option times PREPROCESSING_MARGIN.
+    """
+    amounts = {"--default": 0}
+    for description, count in requirements.items():
+        if "rounds" not in description:
+            option = preprocessing_option(description)
+            amounts[option] = max(amounts.get(option, 0), math.ceil(count * PREPROCESSING_MARGIN))
+    return amounts
 
-    # start sending the input of the patient-donor pairs
+
+def generate_preprocessing(program, ring=False):
+    """
+    Generate the preprocessing material of all computing peers for a compiled program ahead of the online run. Each
+    type of material is generated in the amount required by the program times PREPROCESSING_MARGIN (see
+    preprocessing_amounts). The material is generated by a single dealer process, which is only suitable for testing
+    and benchmarking since the dealer learns all secrets.
+    """
+    with open(requirements_path(program), "r") as file:
+        requirements = json.load(file)
+    amounts = preprocessing_amounts(requirements)
+    lengths = sorted({int(length) for description in requirements
+                      for length in EDABIT_LENGTH_PATTERN.findall(description)}) or EDABIT_LENGTHS
+
+    domain = ["-Z", str(RING_BITS)] if ring else ["-lgp", str(FIELD_BITS)]
+    execute(["../MPSPDZ/Fake-Offline.x", str(COMPUTING_PEERS)] + domain +
+            [value for option, amount in amounts.items() for value in (option, str(amount))] +
+            ["-e", ",".join(map(str, lengths))],
+            "./smpc_protocols", f"\n\nGenerating preprocessing material for {program}")
+
+    with open(PREPROCESSING_MANIFEST, "w") as file:
+        json.dump({"program": program, "ring": ring, "amounts": amounts, "edabit_lengths": lengths, "used": False},
+                  file, indent=2)
+
+
+def check_preprocessing(program, ring=False):
+    """
+    Make sure that the stored preprocessing material was generated for the program and has not been used yet, and that
+    it covers the amounts required by the program.
+    """
+    if not os.path.isfile(PREPROCESSING_MANIFEST):
+        raise Exception("no preprocessing material found, generate it with --offline first")
+    with open(PREPROCESSING_MANIFEST, "r") as file:
+        manifest = json.load(file)
+    with open(requirements_path(program), "r") as file:
+        requirements = json.load(file)
+
+    if manifest["program"] != program or manifest["ring"] != ring:
+        raise Exception(f"the preprocessing material was generated for {manifest['program']}, not for {program}")
+    if manifest["used"]:
+        raise Exception("the preprocessing material has already been used, generate new material with --offline")
+    for description, count in requirements.items():
+        stored = manifest["amounts"].get(preprocessing_option(description), 0)
+        if "rounds" not in description and count > stored:
+            raise Exception(f"the program requires {count:.0f} {description}, but only {stored} are stored")
+
+
+def mark_preprocessing_used():
+    with open(PREPROCESSING_MANIFEST, "r") as file:
+        manifest = json.load(file)
+    manifest["used"] = True
+    with open(PREPROCESSING_MANIFEST, "w") as file:
+        json.dump(manifest, file, indent=2)
+
+
+def round_status(key, clients, changed=(), departed=()):
+    """
+    Whether the state of an earlier round of the program is stored, and the status of each pair (0-based) in the next
+    round of the incremental mode. The state is only used if it was stored by a program with the same compilation
+    cache key, i.e., with the same arguments, flags, and sources, since the layout of the stored state may change with
+    the sources. Pairs that departed in an earlier round stay departed until they are listed as changed, i.e., until a
+    new pair takes their place. Without a stored state, all pairs that are present are new.
+    """
+    manifest = {}
+    if os.path.isfile(STATE_MANIFEST):
+        with open(STATE_MANIFEST, "r") as file:
+            manifest = json.load(file)
+    stored = manifest.get("key") == key and \
+        all(os.path.isfile(os.path.join(PERSISTENCE_DIR, f"Transactions-P{i}.data")) for i in range(COMPUTING_PEERS))
+
+    absent = (set(manifest.get("departed", [])) if stored else set()) | set(departed)
+    absent -= set(changed)
+    status = [STATUS_DEPARTED if pair in absent else STATUS_CHANGED if not stored or pair in changed
+              else STATUS_UNCHANGED for pair in range(clients)]
+    return stored, status
+
+
+def write_round_input(program, stored, status):
+    """
+    Write the public input of a round of the incremental mode, which the computing peers read from
+    Programs/Public-Input/<program>.
+    """
+    os.makedirs(PUBLIC_INPUT_DIR, exist_ok=True)
+    os.makedirs(PERSISTENCE_DIR, exist_ok=True)
+    with open(os.path.join(PUBLIC_INPUT_DIR, program), "w") as file:
+        file.write("\n".join(str(value) for value in [int(stored)] + status) + "\n")
+
+
+def store_round(key, status):
+    with open(STATE_MANIFEST, "w") as file:
+        json.dump({"key": key,
+                   "departed": [pair for pair, value in enumerate(status) if value == STATUS_DEPARTED]}, file, indent=2)
+
+
+def party_command(party, program, protocol=PROTOCOL, batch_size=BATCHSIZE, file_preprocessing=False):
+    """
+    Command line of a computing peer, run in 'smpc_protocols'. With file_preprocessing, the computing peer only uses
+    the stored preprocessing material.
+    """
+    return ["../MPSPDZ/" + protocol, "-b", str(batch_size)] + (["-F"] if file_preprocessing else []) + \
+           ["-h", "localhost", str(party), program]
+
+
+def profile_path():
+    return os.path.join(PROFILE_DIR, socket.gethostname() + ".json")
+
+
+def load_profile(clients):
+    """
+    Protocol and batch size that tune_kep_ap.py found fastest on this host for the tuned pool size closest to clients.
+    Without a profile, the defaults PROTOCOL and BATCHSIZE are returned.
+    """
+    if not os.path.isfile(profile_path()):
+        return PROTOCOL, BATCHSIZE
+
+    with open(profile_path(), "r") as file:
+        profile = json.load(file)
+    if not profile:
+        return PROTOCOL, BATCHSIZE
+    tuned = profile[min(profile, key=lambda pairs: abs(int(pairs) - clients))]
+    return tuned["protocol"], str(tuned["batch_size"])
+
+
+def start_clients(clients, packed):
+    """
+    Start one process per patient-donor pair.
+    """
     popen_clients = []
 
     for i in range(int(clients)):
         if i == (int(clients) - 1):
             popen_clients.append(
                 subprocess.Popen(
-                    ["python", "ExternalIO/kidney-exchange-client.py", str(i), str(COMPUTING_PEERS), str(clients), "1"],
+                    ["python", "ExternalIO/kidney-exchange-client.py", str(i), str(COMPUTING_PEERS), str(clients), "1", str(int(packed))],
                     stdout=subprocess.PIPE, cwd="./MPSPDZ", universal_newlines=True))
         else:
             popen_clients.append(
                 subprocess.Popen(
-                    ["python", "ExternalIO/kidney-exchange-client.py", str(i), str(COMPUTING_PEERS), str(clients), "0"],
+                    ["python", "ExternalIO/kidney-exchange-client.py", str(i), str(COMPUTING_PEERS), str(clients), "0", str(int(packed))],
                     stdout=subprocess.PIPE, cwd="./MPSPDZ", universal_newlines=True))
 
+    return popen_clients
+
+
+def start_client_driver(clients, packed, status=None):
+    """
+    Start a single process that runs all patient-donor pairs concurrently. For a round of the incremental mode, status
+    is the status of each pair.
+    """
+    return subprocess.Popen(
+        ["python", "ExternalIO/kidney-exchange-client.py", "all", str(COMPUTING_PEERS), str(clients), str(int(packed))] +
+        (["".join(str(value) for value in status)] if status else []),
+        stdout=subprocess.PIPE, cwd="./MPSPDZ", universal_newlines=True)
+
+
+def run(clients, packed=False, driver=False, protocol=PROTOCOL, batch_size=BATCHSIZE, threads=1, online=False,
+        incremental=False, changed=(), departed=(), top_k=1):
+    """
+    Run the computing peers and the patient-donor pairs. In driver mode, all patient-donor pairs run in a single process
+    and their exchange partners are returned as a list of rows with the keys 'pair', 'donor', and 'recipient'. In online
+    mode, the computing peers only use the preprocessing material stored by generate_preprocessing, which can be used
+    for a single run. In incremental mode, which requires driver mode, the run is a round of a long-lived pool in which
+    only the changed pairs (0-based) send their input and the departed pairs leave the pool (see round_status).
+    """
+    args = program_args(clients, packed, is_ring(protocol), threads, incremental, top_k=top_k)
+    program = "-".join(args)
+    if online:
+        check_preprocessing(program, is_ring(protocol))
+        mark_preprocessing_used()
+    status = None
+    if incremental:
+        key = compile_cache_key(args, compiler_flags(is_ring(protocol)))
+        stored, status = round_status(key, clients, changed, departed)
+        if all(value == STATUS_DEPARTED for value in status):
+            # nothing to match; a stored state is kept for the next round
+            print("All pairs departed, no round is run")
+            if stored:
+                store_round(key, status)
+            return []
+        write_round_input(program, stored, status)
+
+    # start all computing peers
+    popen_first = subprocess.Popen(party_command(0, program, protocol, batch_size, online), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, cwd="./smpc_protocols", universal_newlines=True)
+
+    for i in range(1, COMPUTING_PEERS):
+        subprocess.Popen(party_command(i, program, protocol, batch_size, online), stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, cwd="./smpc_protocols", universal_newlines=True)
+
+    # start sending the input of the patient-donor pairs
+    if driver:
+        popen_driver = start_client_driver(clients, packed, status)
+    else:
+        popen_clients = start_clients(clients, packed)
+
     for line in popen_first.stdout:
         print(f"{WARNING_COLOR}{line}{END_COLOR}", end='')
 
+    if driver:
+        results = [{key: int(value) for key, value in row.items()} for row in csv.DictReader(popen_driver.stdout)]
+        if popen_driver.wait():
+            raise subprocess.CalledProcessError(popen_driver.returncode, popen_driver.args)
+        if incremental:
+            store_round(key, status)
+        return results
+
     for i in range(len(popen_clients)):
         for line in popen_clients[i].stdout:
             print(f"{OUTPUT_COLORS[i%4]}{line}{END_COLOR}", end='')
 
 
-def main():
-    if len(sys.argv) > 1:
-        clients = int(sys.argv[1])
-    else:
-        clients = 3
+def print_results(results):
+    print(f"{'pair':>6} {'donor':>6} {'recipient':>10}")
+    for row in results:
+        print(f"{OUTPUT_COLORS[(row['pair'] - 1) % 4]}{row['pair']:>6} {row['donor']:>6} {row['recipient']:>10}{END_COLOR}")
 
-    clients = int(clients)
 
-    generate_random_input(clients)
-    compile_code(clients)
-    run(clients)
+def main():
+    parser = argparse.ArgumentParser(description="Compile and run the protocol KEP-AP.")
+    parser.add_argument("clients", nargs="?", type=int, default=3, help="number of patient-donor pairs")
+    parser.add_argument("--packed", action="store_true",
+                        help="send the HLA indicator vectors of each pair bit-packed into a few field elements")
+    parser.add_argument("--no-cache", action="store_true", help="compile even if a cached compilation is available")
+    parser.add_argument("--driver", action="store_true",
+                        help="run all patient-donor pairs in a single process instead of one process per pair")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="number of threads of each computing peer for the construction and evaluation phases")
+    parser.add_argument("--top-k", type=int, default=1,
+                        help="accept up to this many disjoint cycles per iteration of the optimization phase, with "
+                             "proportionally fewer iterations (rounded up to a power of two)")
+    parser.add_argument("--domain", choices=sorted(PROTOCOLS),
+                        help="compute in the prime field or in the ring of integers modulo 2^" + str(RING_BITS) +
+                             " with the default protocol of the domain unless the host profile has a protocol for it")
+    parser.add_argument("--protocol", help="MP-SPDZ protocol binary of the computing peers "
+                                           "(default: from the host profile, otherwise " + PROTOCOL + ")")
+    parser.add_argument("--batch-size", help="preprocessing batch size of the computing peers "
+                                             "(default: from the host profile, otherwise " + BATCHSIZE + ")")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--offline", action="store_true",
+                      help="only compile and generate the preprocessing material for a later run with --online")
+    mode.add_argument("--online", action="store_true",
+                      help="run with the preprocessing material generated by --offline")
+    parser.add_argument("--incremental", action="store_true",
+                        help="run a round of a long-lived pool in which the computing peers keep the inputs and "
+                             "matrices of the last round; implies --driver")
+    parser.add_argument("--changed", nargs="+", type=int, default=[], metavar="PAIR",
+                        help="pairs (1-based) that are new or whose input changed since the last round")
+    parser.add_argument("--departed", nargs="+", type=int, default=[], metavar="PAIR",
+                        help="pairs (1-based) that left the pool since the last round")
+    args = parser.parse_args()
+    if (args.offline or args.online) and args.threads > 1:
+        parser.error("the preprocessing material of --offline is only generated for a single thread")
+    for pair in args.changed + args.departed:
+        if not 1 <= pair <= args.clients:
+            parser.error(f"pair {pair} is not between 1 and {args.clients}")
+
+    protocol, batch_size = load_profile(args.clients)
+    if args.domain and is_ring(protocol) != (args.domain == "ring"):
+        protocol = PROTOCOLS[args.domain]
+    protocol = args.protocol or protocol
+    batch_size = args.batch_size or batch_size
+    print(f"Running {protocol} with batch size {batch_size}")
+
+    generate_random_input(args.clients)
+    setup(args.clients, protocol)
+    compile_code(args.clients, args.packed, not args.no_cache, is_ring(protocol), args.threads, args.incremental,
+                 top_k=args.top_k)
+    if args.offline:
+        generate_preprocessing("-".join(program_args(args.clients, args.packed, is_ring(protocol), args.threads,
+                                                     args.incremental, top_k=args.top_k)), is_ring(protocol))
+        return
+    driver = args.driver or args.incremental
+    results = run(args.clients, args.packed, driver, protocol, batch_size, args.threads, args.online,
+                  args.incremental, [pair - 1 for pair in args.changed], [pair - 1 for pair in args.departed],
+                  args.top_k)
+    if driver:
+        print_results(results)
 
 
 if __name__ == "__main__":
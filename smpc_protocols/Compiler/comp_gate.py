@@ -4,7 +4,7 @@
 """
 
 from Compiler.types import sint, regint, Array, MemValue, Matrix, MultiArray
-from Compiler.library import print_ln, do_while, for_range, print_str, if_, for_range_parallel
+from Compiler.library import print_ln, do_while, for_range, print_str, if_, for_range_parallel, multithread
 from Compiler.networking import write_output_to_clients, client_input, accept_client
 from Compiler.oram import demux_array
 from Compiler.util import if_else
@@ -20,6 +20,53 @@ ANTIGEN_TYPES_DP = 22
 
 SIZE_COMP_INPUT = 2 * BLOOD_TYPES + 2 * ANTIGEN_TYPES
 
+# (offset, length) of the HLA-A, -B, and -DR loci within the antigen indicator vectors
+PRIO_ANTIGEN_LOCI = [(0, ANTIGEN_TYPES_A), (ANTIGEN_TYPES_A, ANTIGEN_TYPES_B),
+                     (ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_C, ANTIGEN_TYPES_DR)]
+PRIO_ANTIGEN_TYPES = ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_DR
+
+# Layout of the input vector that each patient-donor pair sends. The fields are ordered as the rows of the input files;
+# the donor antigens for the prioritization are not sent separately.
+INPUT_BLOOD_DONOR = 0
+INPUT_ANTIGEN_DONOR = INPUT_BLOOD_DONOR + BLOOD_TYPES
+INPUT_BLOOD_PATIENT = INPUT_ANTIGEN_DONOR + ANTIGEN_TYPES
+INPUT_ANTIBODIES_PATIENT = INPUT_BLOOD_PATIENT + BLOOD_TYPES
+INPUT_PRESCORE = INPUT_ANTIBODIES_PATIENT + ANTIGEN_TYPES
+INPUT_PATIENT_ANTIGENS = INPUT_PRESCORE + 1
+INPUT_PATIENT_BLOODTYPE = INPUT_PATIENT_ANTIGENS + PRIO_ANTIGEN_TYPES
+INPUT_DONOR_BLOODTYPE = INPUT_PATIENT_BLOODTYPE + 1
+INPUT_PATIENT_AGE = INPUT_DONOR_BLOODTYPE + 1
+INPUT_DONOR_AGE = INPUT_PATIENT_AGE + 1
+INPUT_PATIENT_REGION = INPUT_DONOR_AGE + 1
+INPUT_DONOR_REGION = INPUT_PATIENT_REGION + 1
+SIZE_INPUT = INPUT_DONOR_REGION + 1
+
+# In the packed input encoding, each HLA indicator vector of a single locus is sent as ceil(length / PACKED_WORD_BITS)
+# words, where bit k of word w is entry w * PACKED_WORD_BITS + k of the indicator vector. All other fields are sent as
+# in the unpacked encoding.
+PACKED_WORD_BITS = 32
+HLA_LOCI = [ANTIGEN_TYPES_A, ANTIGEN_TYPES_B, ANTIGEN_TYPES_C, ANTIGEN_TYPES_DR, ANTIGEN_TYPES_DQ, ANTIGEN_TYPES_DP]
+PRIO_HLA_LOCI = [ANTIGEN_TYPES_A, ANTIGEN_TYPES_B, ANTIGEN_TYPES_DR]
+
+# (offset, length) of the indicator vector of each locus within the unpacked input vector
+HLA_INPUT_FIELDS = []
+for base, loci in ((INPUT_ANTIGEN_DONOR, HLA_LOCI), (INPUT_ANTIBODIES_PATIENT, HLA_LOCI),
+                   (INPUT_PATIENT_ANTIGENS, PRIO_HLA_LOCI)):
+    for length in loci:
+        HLA_INPUT_FIELDS.append((base, length))
+        base += length
+
+def packed_words(length):
+    return -(-length // PACKED_WORD_BITS)
+
+SIZE_PACKED_INPUT = SIZE_INPUT - sum(length - packed_words(length) for _, length in HLA_INPUT_FIELDS)
+
+# status of each pair in a round of the incremental mode: the input of the pair is unchanged since the last round, the
+# pair is new or its input changed, or the pair left the pool
+STATUS_UNCHANGED = 0
+STATUS_CHANGED = 1
+STATUS_DEPARTED = 2
+
 NUM_EQUALITY_CONSTRAINTS = 2
 SIZE_EQUALITY_CONSTRAINTS = 10
 NUM_DIFFERENCE_CONSTRAINTS = 4
@@ -29,6 +76,19 @@ W_AGE_DONOR_DONOR = 10
 NUM_REGIONS = 12
 USE_DISTANCE = 1
 
+def thread_ranges(n_threads, n_items):
+    """
+    Decorator that calls a function with (base, size) for consecutive ranges of n_items items in min(n_threads, n_items)
+    parallel threads. With a single thread, the function is called directly on all items, since multithread of MP-SPDZ
+    starts a new thread even for a single thread.
+    """
+    def decorator(function):
+        if min(n_threads, n_items) > 1:
+            multithread(min(n_threads, n_items), n_items)(function)
+        elif n_items:
+            function(0, n_items)
+    return decorator
+
 REGION_MATRIX = []
 for r in range(NUM_REGIONS):
     REGION_MATRIX.append([0] * NUM_REGIONS)
@@ -38,7 +98,47 @@ for r1 in range(NUM_REGIONS):
         if abs(r1-r2) < 4:
             REGION_MATRIX[r1][r2] = 100 - abs(r1 - r2) * 25
 
-def compute_prioritization_weight(prescores, patient_antigens, donor_antigens, patient_bloodtype, donor_bloodtype, patient_age, donor_of_patient_age, donor_age, patient_region, donor_region):
+def compute_region_indicators(regions, num_clients):
+    """
+    Demux the region of each client into a binary indicator vector. Row r of the returned matrix indicates for each
+    client whether it belongs to region r.
+    """
+    indicators = sint.Matrix(NUM_REGIONS, num_clients)
+
+    @for_range_parallel(num_clients, num_clients)
+    def _(client_id):
+        index_bits = regions[client_id][0].bit_decompose(NUM_REGIONS.bit_length())
+        selection = demux_array(index_bits)
+        for r in range(NUM_REGIONS):
+            indicators[r][client_id] = selection[r]
+
+    return indicators
+
+def compute_region_weights(patient_region, donor_region, num_clients):
+    """
+    Region indicators of the donors multiplied with the public REGION_MATRIX and region indicators of the patients.
+    The distance weight of entry [i][j] is the dot product of column i of the former with column j of the latter.
+    """
+    patient_indicators = compute_region_indicators(patient_region, num_clients)
+    donor_indicators = compute_region_indicators(donor_region, num_clients)
+
+    weighted_donor_indicators = sint.Matrix(NUM_REGIONS, num_clients)
+    for r1 in range(NUM_REGIONS):
+        weighted_donor_indicators[r1] = sum(REGION_MATRIX[r1][r2] * donor_indicators[r2].get_vector()
+                                            for r2 in range(NUM_REGIONS) if REGION_MATRIX[r1][r2] != 0)
+
+    return weighted_donor_indicators, patient_indicators
+
+def compute_region_distance(patient_region, donor_region, num_clients):
+    """
+    Compute the distance weight REGION_MATRIX[region of patient j][region of donor i] for each entry [i][j] as the
+    bilinear form of the two region indicators with the public REGION_MATRIX. The region indicators are computed once
+    per client and the multiplication with REGION_MATRIX is local, so only a single matrix product remains.
+    """
+    weighted_donor_indicators, patient_indicators = compute_region_weights(patient_region, donor_region, num_clients)
+    return weighted_donor_indicators.transpose().dot(patient_indicators)
+
+def compute_prioritization_weight(prescores, patient_antigens, donor_antigens, patient_bloodtype, donor_bloodtype, patient_age, donor_of_patient_age, donor_age, dist_weight):
     w_antigens = Array(1, sint)
     w_antigens[0] = sint.dot_product(patient_antigens, donor_antigens) < W_ANTIGEN_BOUND
 
@@ -51,32 +151,47 @@ def compute_prioritization_weight(prescores, patient_antigens, donor_antigens, p
     w_age_donor_donor = Array(1, sint)
     w_age_donor_donor[0] = ((donor_of_patient_age[0] - donor_age[0]) * (donor_age[0] - donor_of_patient_age[0])) < W_AGE_DONOR_DONOR
 
-    index_bits_row = patient_region[0].bit_decompose(NUM_REGIONS.bit_length())
-    selection_row = demux_array(index_bits_row)
-
-    index_bits_col = donor_region[0].bit_decompose(NUM_REGIONS.bit_length())
-    selection_col = demux_array(index_bits_col)
+    return prescores[0] + w_antigens[0] + w_bloodtypes[0] + w_age_patient_donor[0] + w_age_donor_donor[0] + dist_weight
 
-    dist_weight = Array(1, sint)
-    dist_weight[0] = sint(0)
-
-    @for_range_parallel(NUM_REGIONS, NUM_REGIONS)
-    def _(i):
-        @for_range_parallel(NUM_REGIONS, NUM_REGIONS)
-        def _(j):
-            dist_weight[0] = if_else(selection_row[i] * selection_col[j], REGION_MATRIX[i][j], dist_weight[0])
-
-    return prescores[0] + w_antigens[0] + w_bloodtypes[0] + w_age_patient_donor[0] + w_age_donor_donor[0] + dist_weight[0]
-
-def compute_prio_matrix(prescores, patient_antigens, donor_antigens, patient_bloodtype, donor_bloodtype, patient_age, donor_age, patient_region, donor_region, num_clients):
+def compute_prio_matrix(prescores, patient_antigens, donor_antigens, patient_bloodtype, donor_bloodtype, patient_age, donor_age, patient_region, donor_region, num_clients, n_threads=1):
+    """
+    Compute the prioritization matrix for all pairs at once. Entry [i][j] is the weight of compute_prioritization_weight
+    for donor i and patient j. The antigen dot products of all entries are a single matrix product, and the ages and
+    blood types of donor i and patient j are gathered from the per-pair inputs with public index vectors, so that each
+    type of comparison is a single vectorized step over consecutive ranges of rows in n_threads parallel threads.
+    """
     prio_matrix = sint.Matrix(num_clients, num_clients)
-    prio_matrix.assign_all(sint(0))
-
-    @for_range_parallel(num_clients, num_clients)
-    def _(i):
-        @for_range_parallel(num_clients, num_clients)
-        def _(j):
-            prio_matrix[i][j] = compute_prioritization_weight(prescores[j], patient_antigens[j], donor_antigens[i], patient_bloodtype[j], donor_bloodtype[i], patient_age[j], donor_age[j], donor_age[i], patient_region[j], donor_region[i])
+    prio = Array(num_clients * num_clients, sint, address=prio_matrix.address)
+
+    antigens = donor_antigens.dot(patient_antigens.transpose())
+    dist_matrix = compute_region_distance(patient_region, donor_region, num_clients)
+    antigens, dist = (Array(num_clients * num_clients, sint, address=product.address)
+                      for product in (antigens, dist_matrix))
+    prescores, patient_bloodtype, donor_bloodtype, patient_age, donor_age = (
+        Array(num_clients, sint, address=column.address)
+        for column in (prescores, patient_bloodtype, donor_bloodtype, patient_age, donor_age))
+    # donor i of each entry [i][j]
+    donor_index = Array(num_clients * num_clients, regint)
+    donor_index.assign(regint.inc(num_clients * num_clients, 0, 1, num_clients))
+
+    @thread_ranges(n_threads, num_clients)
+    def _(base, size):
+        offset = base * num_clients
+        length = size * num_clients
+        donors = donor_index.get_vector(offset, length)
+        patients = regint.inc(length, 0, 1, 1, num_clients)
+
+        w_antigens = antigens.get_vector(offset, length) < W_ANTIGEN_BOUND
+        w_bloodtypes = patient_bloodtype.get(patients) == donor_bloodtype.get(donors)
+
+        patient_ages = patient_age.get(patients)
+        donor_of_patient_ages = donor_age.get(patients)
+        donor_ages = donor_age.get(donors)
+        w_age_patient_donor = ((patient_ages - donor_ages) * (donor_ages - patient_ages)) < W_AGE_PATIENT_DONOR
+        w_age_donor_donor = ((donor_of_patient_ages - donor_ages) * (donor_ages - donor_of_patient_ages)) < W_AGE_DONOR_DONOR
+
+        prio.assign_vector(prescores.get(patients) + w_antigens + w_bloodtypes + w_age_patient_donor +
+                           w_age_donor_donor + dist.get_vector(offset, length), offset)
 
     return prio_matrix
 
@@ -96,136 +211,112 @@ def compute_compatibility(blood_donor, antigen_donor, blood_patient, antigen_pat
     return ohb * oha
 
 
-def compute_comp_matrix(blood_donor, blood_patient, antigen_donor, antigen_patient, num_clients):
+def compute_comp_matrix(blood_donor, blood_patient, antigen_donor, antigen_patient, num_clients, n_threads=1):
+    """
+    Compute the adjacency matrix for all pairs at once. Entry [i][j] of the products below is the dot product of the
+    input of donor i with the input of patient j, i.e., the sums computed by compute_compatibility for each pair. The
+    zero-tests are then executed as vectorized steps over consecutive ranges of rows in n_threads parallel threads.
+    """
     adjacency_matrix = sint.Matrix(num_clients, num_clients)
-    adjacency_matrix.assign_all(sint(0))
-
-    @for_range_parallel(num_clients, num_clients)
-    def _(client_i):
-        @for_range_parallel(num_clients, num_clients)
-        def _(client_j):
-            adjacency_matrix[client_i][client_j] = compute_compatibility(blood_donor[client_i],
-                                                                         antigen_donor[client_i],
-                                                                         blood_patient[client_j],
-                                                                         antigen_patient[client_j])
-
-    return adjacency_matrix
-
+    adjacency = Array(num_clients * num_clients, sint, address=adjacency_matrix.address)
 
-def read_input(num_clients):
-    blood_donor = sint.Matrix(num_clients, BLOOD_TYPES)
-    blood_patient = sint.Matrix(num_clients, BLOOD_TYPES)
-    antigen_donor = sint.Matrix(num_clients, ANTIGEN_TYPES)
-    antibodies_patient = sint.Matrix(num_clients, ANTIGEN_TYPES)
-
-    @for_range(num_clients)
-    def _(client_id):
-        blood_donor[client_id] = client_input(client_id, BLOOD_TYPES)
-        blood_patient[client_id] = client_input(client_id, BLOOD_TYPES)
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_A)
-        for i in range(ANTIGEN_TYPES_A):
-            antigen_donor[client_id][i] = tmp[i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_A)
-
-        for i in range(ANTIGEN_TYPES_A):
-            antibodies_patient[client_id][i] = tmp[i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_B)
-
-        for i in range(ANTIGEN_TYPES_B):
-            antigen_donor[client_id][ANTIGEN_TYPES_A + i] = tmp[i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_B)
-
-        for i in range(ANTIGEN_TYPES_B):
-            antibodies_patient[client_id][ANTIGEN_TYPES_A + i] = tmp[i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_C)
-
-        for i in range(ANTIGEN_TYPES_C):
-            antigen_donor[client_id][ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + i] = tmp[i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_C)
+    sumb = blood_donor.dot(blood_patient.transpose())
+    suma = antigen_donor.dot(antigen_patient.transpose())
+    sumb, suma = (Array(num_clients * num_clients, sint, address=product.address) for product in (sumb, suma))
 
-        for i in range(ANTIGEN_TYPES_C):
-            antibodies_patient[client_id][ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + i] = tmp[i]
+    @thread_ranges(n_threads, num_clients)
+    def _(base, size):
+        ohb = sumb.get_vector(base * num_clients, size * num_clients) > 0
+        oha = suma.get_vector(base * num_clients, size * num_clients) < 1
+        adjacency.assign_vector(ohb * oha, base * num_clients)
 
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_DR)
-
-        for i in range(ANTIGEN_TYPES_DR):
-            antigen_donor[client_id][ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_C + i] = \
-                tmp[
-                    i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_DR)
+    return adjacency_matrix
 
-        for i in range(ANTIGEN_TYPES_DR):
-            antibodies_patient[client_id][ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_C + i] = \
-                tmp[i]
 
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_DQ)
+def update_matrices(adjacency_matrix, prio_matrix, comp_input, prio_input, status, num_clients):
+    """
+    Bring the adjacency matrix and the prioritization matrix of the previous round up to date. The row and the column
+    of each pair with status STATUS_CHANGED are recomputed with compute_compatibility and
+    compute_prioritization_weight, and the row and the column of each pair with status STATUS_DEPARTED are cleared in
+    the adjacency matrix in a second pass, so that the pair is not part of any exchange. All other entries are kept, so
+    only O(num_clients * number of changed pairs) entries are computed.
+    """
+    blood_donor, blood_patient, antigen_donor, antigen_patient = comp_input
+    prescores, patient_antigens, donor_antigens, patient_bloodtype, donor_bloodtype, patient_age, donor_age, patient_region, donor_region = prio_input
 
-        for i in range(ANTIGEN_TYPES_DQ):
-            antigen_donor[client_id][
-                ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_C + ANTIGEN_TYPES_DR + i] = \
-                tmp[
-                    i]
+    weighted_donor_indicators, patient_indicators = compute_region_weights(patient_region, donor_region, num_clients)
+    weighted_donor_indicators = weighted_donor_indicators.transpose()
+    patient_indicators = patient_indicators.transpose()
 
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_DQ)
+    def compatibility(i, j):
+        return compute_compatibility(blood_donor[i], antigen_donor[i], blood_patient[j], antigen_patient[j])
 
-        for i in range(ANTIGEN_TYPES_DQ):
-            antibodies_patient[client_id][
-                ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_C + ANTIGEN_TYPES_DR + i] = \
-                tmp[i]
+    def weight(i, j):
+        dist_weight = sint.dot_product(weighted_donor_indicators[i], patient_indicators[j])
+        return compute_prioritization_weight(prescores[j], patient_antigens[j], donor_antigens[i], patient_bloodtype[j], donor_bloodtype[i], patient_age[j], donor_age[j], donor_age[i], dist_weight)
 
     @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_DP)
-
-        for i in range(ANTIGEN_TYPES_DP):
-            antigen_donor[client_id][
-                ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_C + ANTIGEN_TYPES_DR + ANTIGEN_TYPES_DQ + i] = \
-                tmp[i]
-
+    def _(i):
+        @if_(status[i] == STATUS_CHANGED)
+        def _():
+            @for_range_parallel(num_clients, num_clients)
+            def _(j):
+                adjacency_matrix[i][j] = compatibility(i, j)
+                adjacency_matrix[j][i] = compatibility(j, i)
+                prio_matrix[i][j] = weight(i, j)
+                prio_matrix[j][i] = weight(j, i)
+
+    # The departed pairs are cleared after all recomputations, which would otherwise write the entries of a departed
+    # pair j < i again when the row and the column of a changed pair i are recomputed.
     @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_DP)
-
-        for i in range(ANTIGEN_TYPES_DP):
-            antibodies_patient[client_id][
-                ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_C + ANTIGEN_TYPES_DR + ANTIGEN_TYPES_DQ + i] = \
-                tmp[i]
-
-
-    return blood_donor, blood_patient, antigen_donor, antibodies_patient
-
+    def _(i):
+        @if_(status[i] == STATUS_DEPARTED)
+        def _():
+            adjacency_matrix[i].assign_all(0)
+            @for_range(num_clients)
+            def _(j):
+                adjacency_matrix[j][i] = sint(0)
+
+
+def unpack_input(packed, unpacked):
+    """
+    Expand an input vector in the packed encoding into the unpacked layout. Each packed word is bit decomposed once.
+    """
+    position = 0
+    offset = 0
+    for base, length in HLA_INPUT_FIELDS:
+        if base > offset:
+            unpacked.assign_vector(packed.get_vector(position, base - offset), offset)
+            position += base - offset
+        for word in range(packed_words(length)):
+            n_bits = min(PACKED_WORD_BITS, length - word * PACKED_WORD_BITS)
+            bits = packed[position].bit_decompose(n_bits)
+            for k in range(n_bits):
+                unpacked[base + word * PACKED_WORD_BITS + k] = bits[k]
+            position += 1
+        offset = base + length
+
+    unpacked.assign_vector(packed.get_vector(position, SIZE_INPUT - offset), offset)
+
+
+def read_input(num_clients, packed=False, received=None, status=None, emulate=False):
+    """
+    Receive the input of all patient-donor pairs. Each pair sends all of its compatibility and prioritization input as
+    a single vector (see INPUT_* for the layout), which is sliced into the input matrices with vector assignments.
+    If packed is set, the HLA indicator vectors are received in the packed encoding (see PACKED_WORD_BITS).
+    If status is given, only the pairs with status STATUS_CHANGED send their input; the rows of received of all other
+    pairs are kept, e.g., as restored from the persistent storage of an earlier round, except that the rows of pairs
+    with status STATUS_DEPARTED are set to 0. With emulate, the input vectors of all pairs are read one after the other
+    from the private input of the first computing peer instead.
+    """
+    blood_donor = sint.Matrix(num_clients, BLOOD_TYPES)
+    blood_patient = sint.Matrix(num_clients, BLOOD_TYPES)
+    antigen_donor = sint.Matrix(num_clients, ANTIGEN_TYPES)
+    antibodies_patient = sint.Matrix(num_clients, ANTIGEN_TYPES)
 
-def read_prio_input(num_clients):
     prescores = Matrix(num_clients, 1, sint)
-    patient_antigens = Matrix(num_clients, ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_DR, sint)
-    donor_antigens = Matrix(num_clients, ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + ANTIGEN_TYPES_DR, sint)
+    patient_antigens = Matrix(num_clients, PRIO_ANTIGEN_TYPES, sint)
+    donor_antigens = Matrix(num_clients, PRIO_ANTIGEN_TYPES, sint)
     patient_bloodtype = Matrix(num_clients, 1, sint)
     donor_bloodtype = Matrix(num_clients, 1, sint)
     patient_age = Matrix(num_clients, 1, sint)
@@ -233,57 +324,50 @@ def read_prio_input(num_clients):
     patient_region = Matrix(num_clients, 1, sint)
     donor_region = Matrix(num_clients, 1, sint)
 
-    @for_range(num_clients)
-    def _(client_id):
-        prescores[client_id] = client_input(client_id, 1)
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_A)
-        for i in range(ANTIGEN_TYPES_A):
-            patient_antigens[client_id][i] = tmp[i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_B)
-
-        for i in range(ANTIGEN_TYPES_B):
-            patient_antigens[client_id][ANTIGEN_TYPES_A + i] = tmp[i]
+    if received is None:
+        received = Matrix(num_clients, SIZE_INPUT, sint)
+    packed_received = Array(SIZE_PACKED_INPUT, sint)
 
     @for_range(num_clients)
     def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_DR)
-
-        for i in range(ANTIGEN_TYPES_DR):
-            patient_antigens[client_id][ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + i] = tmp[i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_A)
-        for i in range(ANTIGEN_TYPES_A):
-            donor_antigens[client_id][i] = tmp[i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_B)
-
-        for i in range(ANTIGEN_TYPES_B):
-            donor_antigens[client_id][ANTIGEN_TYPES_A + i] = tmp[i]
-
-    @for_range(num_clients)
-    def _(client_id):
-        tmp = client_input(client_id, ANTIGEN_TYPES_DR)
-
-        for i in range(ANTIGEN_TYPES_DR):
-            donor_antigens[client_id][ANTIGEN_TYPES_A + ANTIGEN_TYPES_B + i] = tmp[i]
+        def receive():
+            length = SIZE_PACKED_INPUT if packed else SIZE_INPUT
+            values = sint.get_input_from(0, size=length) if emulate else client_input(client_id, length)
+            if packed:
+                packed_received.assign(values)
+                unpack_input(packed_received, received[client_id])
+            else:
+                received[client_id].assign(values)
+
+        if status is None:
+            receive()
+        else:
+            if_(status[client_id] == STATUS_CHANGED)(receive)
+            # the stored input of a departed pair is not kept
+            if_(status[client_id] == STATUS_DEPARTED)(lambda: received[client_id].assign_all(0))
 
     @for_range(num_clients)
     def _(client_id):
-        patient_bloodtype[client_id] = client_input(client_id, 1)
-        donor_bloodtype[client_id] = client_input(client_id, 1)
-        patient_age[client_id] = client_input(client_id, 1)
-        donor_age[client_id] = client_input(client_id, 1)
-        patient_region[client_id] = client_input(client_id, 1)
-        donor_region[client_id] = client_input(client_id, 1)
-
-    return prescores, patient_antigens, donor_antigens, patient_bloodtype, donor_bloodtype, patient_age, donor_age, patient_region, donor_region
\ No newline at end of file
+        row = received[client_id]
+        blood_donor[client_id].assign_vector(row.get_vector(INPUT_BLOOD_DONOR, BLOOD_TYPES))
+        antigen_donor[client_id].assign_vector(row.get_vector(INPUT_ANTIGEN_DONOR, ANTIGEN_TYPES))
+        blood_patient[client_id].assign_vector(row.get_vector(INPUT_BLOOD_PATIENT, BLOOD_TYPES))
+        antibodies_patient[client_id].assign_vector(row.get_vector(INPUT_ANTIBODIES_PATIENT, ANTIGEN_TYPES))
+
+        prescores[client_id][0] = row[INPUT_PRESCORE]
+        patient_antigens[client_id].assign_vector(row.get_vector(INPUT_PATIENT_ANTIGENS, PRIO_ANTIGEN_TYPES))
+        # the donor antigens used for the prioritization are the A, B, and DR loci of the compatibility input
+        base = 0
+        for offset, length in PRIO_ANTIGEN_LOCI:
+            donor_antigens[client_id].assign_vector(row.get_vector(INPUT_ANTIGEN_DONOR + offset, length), base)
+            base += length
+        patient_bloodtype[client_id][0] = row[INPUT_PATIENT_BLOODTYPE]
+        donor_bloodtype[client_id][0] = row[INPUT_DONOR_BLOODTYPE]
+        patient_age[client_id][0] = row[INPUT_PATIENT_AGE]
+        donor_age[client_id][0] = row[INPUT_DONOR_AGE]
+        patient_region[client_id][0] = row[INPUT_PATIENT_REGION]
+        donor_region[client_id][0] = row[INPUT_DONOR_REGION]
+
+    comp_input = blood_donor, blood_patient, antigen_donor, antibodies_patient
+    prio_input = prescores, patient_antigens, donor_antigens, patient_bloodtype, donor_bloodtype, patient_age, donor_age, patient_region, donor_region
+    return comp_input, prio_input
@@ -35,10 +35,13 @@ def accept_client():
     return client_socket_id, last
 
 
-def close_connections(number_clients):
+def close_connections(number_clients, present=None):
     @for_range(number_clients)
     def _(i):
-        closeclientconnection(i)
+        if present is None:
+            closeclientconnection(i)
+        else:
+            if_(present[i])(lambda: closeclientconnection(i))
 
 
 def client_input(client_socket_id, length):
@@ -49,7 +52,11 @@ def client_input(client_socket_id, length):
     return sint.receive_from_client(length, client_socket_id)
 
 
-def setup_client_connections(port_num, num_clients):
+def setup_client_connections(port_num, num_clients, expected=None):
+    """
+    Wait until all clients up to the client that announced itself as the last one are connected. If expected is given,
+    wait for this number of clients instead, so that the client ids do not need to be consecutive.
+    """
     # start listening for client socket connections
     listen_for_clients(port_num)
     print_ln('Listening for client connections on base port %s', port_num)
@@ -82,23 +89,36 @@ def setup_client_connections(port_num, num_clients):
         def _():
             number_clients.write(client_id + 1)
 
+        if expected is not None:
+            return sum(seen) < expected
         return (sum(seen) < number_clients) + (number_clients == 0)
 
     return number_clients, client_sockets
 
-def write_output_to_clients(sockets, number_clients, output):
+def write_output_to_clients(sockets, number_clients, *outputs, present=None):
+    """
+    Send entry i of every output to client i in a single message. Each value is followed by a random value and the
+    product of both, so that the client can check the received shares. The random values for all clients and outputs
+    are drawn and multiplied in one batch. If present is given, only the clients i with present[i] != 0 are served.
+    """
+    size = len(outputs[0])
+    values = Array(len(outputs) * size, sint)
+    for k, output in enumerate(outputs):
+        values.assign_vector(output.get_vector(), k * size)
+    randomness = Array(len(values), sint)
+    randomness.assign_vector(sint.get_random(size=len(values)))
+    auth = Array(len(values), sint)
+    auth.assign_vector(values.get_vector() * randomness.get_vector())
+
     @for_range(number_clients)
     def loop_body(i):
-        r = sint.get_random()
-        to_send = [output[i], r, output[i] * r]
-        sint.write_shares_to_socket(sockets[i], to_send)
-
-
-def write_output_to_client(socket, recipient, donor):
-    rnd_from_triple = sint.get_random_triple()[0]
-    auth_result = recipient * rnd_from_triple
-    sint.write_shares_to_socket(socket, [recipient, rnd_from_triple, auth_result])
-
-    rnd_from_triple = sint.get_random_triple()[0]
-    auth_result = donor * rnd_from_triple
-    sint.write_shares_to_socket(socket, [donor, rnd_from_triple, auth_result])
+        def send():
+            to_send = []
+            for k in range(len(outputs)):
+                to_send += [values[k * size + i], randomness[k * size + i], auth[k * size + i]]
+            sint.write_shares_to_socket(sockets[i], to_send)
+
+        if present is None:
+            send()
+        else:
+            if_(present[i])(send)
@@ -1,149 +1,154 @@
 #!/usr/bin/python3
+"""
+Input peer of the protocol KEP-AP.
 
+Usage:
+    kidney-exchange-client.py <client id> <number of computing peers> <number of input peers> <finish> [<packed>]
+    kidney-exchange-client.py all <number of computing peers> <number of input peers> [<packed> [<status>]]
+
+The first form runs a single patient-donor pair. The second form runs all patient-donor pairs concurrently in one
+process and prints their exchange partners as a CSV table. For a round of the incremental mode, status holds one digit
+per pair (see STATUS_* in Compiler/comp_gate.py): only new or changed pairs send their input, and pairs that departed
+do not connect.
+"""
+
+import csv
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append('.')
 
 from client import *
 from domains import *
 
-client_id = int(sys.argv[1])
-n_computing_peers = int(sys.argv[2])
-n_input_peers = int(sys.argv[3])
-finish = int(sys.argv[4])
-
-
-client = Client(['localhost'] * n_computing_peers, 14000, client_id)
-
-type = client.specification.get_int(4)
-
-if type == ord('p'):
-    domain = Fp(client.specification.get_bigint())
-else:
-    raise Exception('invalid type')
-
-for socket in client.sockets:
-    os = octetStream()
-    os.store(finish)
-    os.Send(socket)
-
-input_data = []
-with open("ExternalIO/Inputs/input_"+str(client_id)+".txt") as f:
-    for l in f:
-        input_data.append(l.split(" "))
-
-# compatibility check input
-donor_blood = []
-patient_blood = []
-donor_antigens_a = []
-donor_antigens_b = []
-donor_antigens_c = []
-donor_antigens_dr = []
-donor_antigens_dq = []
-donor_antigens_dp = []
-patient_antibodies_a = []
-patient_antibodies_b = []
-patient_antibodies_c = []
-patient_antibodies_dr = []
-patient_antibodies_dq = []
-patient_antibodies_dp = []
-# prioritization input
-prescores = []
-patient_antigens_a = []
-patient_antigens_b = []
-patient_antigens_dr = []
-patient_bloodtype = []
-donor_bloodtype = []
-patient_age = []
-donor_age = []
-patient_region = []
-donor_region = []
-
-for i in range(len(input_data)):
-    for j in range(len(input_data[i])):
-        if i == 0:
-            donor_blood.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 1:
-            donor_antigens_a.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 2:
-            donor_antigens_b.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 3:
-            donor_antigens_c.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 4:
-            donor_antigens_dr.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 5:
-            donor_antigens_dq.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 6:
-            donor_antigens_dp.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 7:
-            patient_blood.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 8:
-            patient_antibodies_a.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 9:
-            patient_antibodies_b.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 10:
-            patient_antibodies_c.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 11:
-            patient_antibodies_dr.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 12:
-            patient_antibodies_dq.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 13:
-            patient_antibodies_dp.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 14:
-            prescores.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 15:
-            patient_antigens_a.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 16:
-            patient_antigens_b.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 17:
-            patient_antigens_dr.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 18:
-            patient_bloodtype.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 19:
-            donor_bloodtype.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 20:
-            patient_age.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 21:
-            donor_age.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 22:
-            patient_region.append(domain(int(input_data[i][j].rstrip())))
-        elif i == 23:
-            donor_region.append(domain(int(input_data[i][j].rstrip())))
-
-# send input for compatibility check
-client.send_private_inputs(donor_blood)
-client.send_private_inputs(patient_blood)
-client.send_private_inputs(donor_antigens_a)
-client.send_private_inputs(patient_antibodies_a)
-client.send_private_inputs(donor_antigens_b)
-client.send_private_inputs(patient_antibodies_b)
-client.send_private_inputs(donor_antigens_c)
-client.send_private_inputs(patient_antibodies_c)
-client.send_private_inputs(donor_antigens_dr)
-client.send_private_inputs(patient_antibodies_dr)
-client.send_private_inputs(donor_antigens_dq)
-client.send_private_inputs(patient_antibodies_dq)
-client.send_private_inputs(donor_antigens_dp)
-client.send_private_inputs(patient_antibodies_dp)
-
-# send input for prioritization
-client.send_private_inputs(prescores)
-client.send_private_inputs(patient_antigens_a)
-client.send_private_inputs(patient_antigens_b)
-client.send_private_inputs(patient_antigens_dr)
-client.send_private_inputs(donor_antigens_a)
-client.send_private_inputs(donor_antigens_b)
-client.send_private_inputs(donor_antigens_dr)
-client.send_private_inputs(patient_bloodtype)
-client.send_private_inputs(donor_bloodtype)
-client.send_private_inputs(patient_age)
-client.send_private_inputs(donor_age)
-client.send_private_inputs(patient_region)
-client.send_private_inputs(donor_region)
-
-
-donor = client.receive_outputs(domain, 1)[0].v % 2 ** 64
-print("Client"+str(client_id+1)+": The donor for your patient is: "+str(donor))
-
-patient = client.receive_outputs(domain, 1)[0].v % 2 ** 64
-print("Client"+str(client_id+1)+": The recipient for your donor is: "+str(patient))
\ No newline at end of file
+PORT_NUM = 14000
+
+# number of values in each row of the input file (see README)
+HLA_LOCI = [59, 132, 48, 61, 26, 22]
+PRIO_HLA_LOCI = [59, 132, 61]
+INPUT_ROW_LENGTHS = [4] + HLA_LOCI + [4] + HLA_LOCI + [1] + PRIO_HLA_LOCI + [1] * 6
+HLA_ROWS = list(range(1, 7)) + list(range(8, 14)) + list(range(15, 18))
+
+# packed encoding of the HLA indicator vectors, see PACKED_WORD_BITS in Compiler/comp_gate.py
+PACKED_WORD_BITS = 32
+
+# status of a pair in a round of the incremental mode, see STATUS_* in Compiler/comp_gate.py
+STATUS_CHANGED = 1
+STATUS_DEPARTED = 2
+
+
+def packed_words(length):
+    return -(-length // PACKED_WORD_BITS)
+
+
+def parse_row(tokens, length, hla):
+    """
+    HLA indicator vectors are either given as 0/1 values or packed as hexadecimal words ('0x...'), where bit k of word
+    w is entry w * PACKED_WORD_BITS + k of the indicator vector. All other rows only hold decimal values.
+    """
+    if any(token.startswith('0x') for token in tokens):
+        if not hla:
+            raise Exception('hexadecimal words are only allowed in the rows of HLA indicator vectors')
+        words = [int(token, 16) for token in tokens]
+        if len(words) != packed_words(length):
+            raise Exception(f'packed row has {len(words)} words, expected {packed_words(length)} for {length} values')
+        return [(words[k // PACKED_WORD_BITS] >> (k % PACKED_WORD_BITS)) & 1 for k in range(length)]
+    return [int(token) for token in tokens]
+
+
+def pack_row(bits):
+    return [sum(bit << k for k, bit in enumerate(bits[w:w + PACKED_WORD_BITS]))
+            for w in range(0, len(bits), PACKED_WORD_BITS)]
+
+
+def read_input(client_id, packed):
+    """
+    Read the input file of a patient-donor pair and return the values in the order in which they are sent.
+    """
+    with open("ExternalIO/Inputs/input_"+str(client_id)+".txt") as f:
+        rows = [l.split() for l in f if l.strip()]
+
+    input_data = [parse_row(tokens, length, i in HLA_ROWS)
+                  for i, (tokens, length) in enumerate(zip(rows, INPUT_ROW_LENGTHS))]
+
+    if len(rows) != len(INPUT_ROW_LENGTHS) or [len(row) for row in input_data] != INPUT_ROW_LENGTHS:
+        raise Exception('invalid input file for client ' + str(client_id))
+
+    if packed:
+        for i in HLA_ROWS:
+            input_data[i] = pack_row(input_data[i])
+
+    return [value for row in input_data for value in row]
+
+
+def run_client(client_id, n_computing_peers, finish, packed, send_input=True):
+    """
+    Send the input of a patient-donor pair to the computing peers and return the exchange partners of its patient and
+    donor. Without send_input, the computing peers use the input of the pair stored in an earlier round.
+    """
+    client = Client(['localhost'] * n_computing_peers, PORT_NUM, client_id)
+
+    type = client.specification.get_int(4)
+
+    if type == ord('R'):
+        domain = Z2(client.specification.get_int(4))
+    elif type == ord('p'):
+        domain = Fp(client.specification.get_bigint())
+    else:
+        raise Exception('invalid type')
+
+    for socket in client.sockets:
+        os = octetStream()
+        os.store(finish)
+        os.Send(socket)
+
+    # send the compatibility and prioritization input as a single vector in the order of the rows of the input file
+    if send_input:
+        client.send_private_inputs([domain(value) for value in read_input(client_id, packed)])
+
+    # donor and recipient arrive in a single message
+    donor, patient = (output.v % 2 ** 64 for output in client.receive_outputs(domain, 2))
+    return donor, patient
+
+
+def run_all_clients(n_computing_peers, n_input_peers, packed, status=None):
+    """
+    Run all patient-donor pairs concurrently in the current process. The computing peers only send outputs once all
+    inputs are received, so every pair needs its own worker.
+    """
+    status = status or [STATUS_CHANGED] * n_input_peers
+    pairs = [i for i in range(n_input_peers) if status[i] != STATUS_DEPARTED]
+    if not pairs:
+        return []
+    with ThreadPoolExecutor(max_workers=len(pairs)) as executor:
+        futures = [executor.submit(run_client, i, n_computing_peers, int(i == pairs[-1]), packed,
+                                   status[i] == STATUS_CHANGED)
+                   for i in pairs]
+        results = [future.result() for future in futures]
+
+    return [{"pair": i + 1, "donor": donor, "recipient": recipient} for i, (donor, recipient) in zip(pairs, results)]
+
+
+def main():
+    n_computing_peers = int(sys.argv[2])
+    n_input_peers = int(sys.argv[3])
+
+    if sys.argv[1] == 'all':
+        packed = len(sys.argv) > 4 and int(sys.argv[4]) == 1
+        status = [int(digit) for digit in sys.argv[5]] if len(sys.argv) > 5 else None
+        writer = csv.DictWriter(sys.stdout, fieldnames=["pair", "donor", "recipient"])
+        writer.writeheader()
+        writer.writerows(run_all_clients(n_computing_peers, n_input_peers, packed, status))
+        return
+
+    client_id = int(sys.argv[1])
+    finish = int(sys.argv[4])
+    packed = len(sys.argv) > 5 and int(sys.argv[5]) == 1
+
+    donor, patient = run_client(client_id, n_computing_peers, finish, packed)
+    print("Client"+str(client_id+1)+": The donor for your patient is: "+str(donor))
+    print("Client"+str(client_id+1)+": The recipient for your donor is: "+str(patient))
+
+
+if __name__ == "__main__":
+    main()
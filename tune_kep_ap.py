@@ -0,0 +1,110 @@
+"""
+Tune the protocol backend and the preprocessing batch size of the computing peers for a pool size.
+
+Every combination of the given protocols and batch sizes is run a number of times. The configuration with the smallest
+median sum of the phase timers is stored in the profile of this host (see run_kep_ap.PROFILE_DIR), which
+run_kep_ap.py loads automatically.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+
+import benchmark_kep_ap
+import run_kep_ap
+
+# honest-majority backends for three computing peers in the field and in the ring domain
+PROTOCOLS = ["replicated-field-party.x", "shamir-party.x", "ps-rep-field-party.x", "replicated-ring-party.x",
+             "ps-rep-ring-party.x"]
+BATCH_SIZES = [1000, 10000, 100000]
+# seconds after which a run is stopped and its configuration left out
+RUN_TIMEOUT = 3600
+
+
+def phase_seconds(parties):
+    run = benchmark_kep_ap.summarize_run(parties)
+    return sum(run[f"time_{name}"] or 0 for name in benchmark_kep_ap.TIMERS.values())
+
+
+def tune(clients, packed, protocols, batch_sizes, repetitions, max_rss_kb=None, timeout=RUN_TIMEOUT):
+    """
+    Run all configurations and return their results sorted by the median sum of the phase timers. Configurations that
+    fail, that take longer than timeout seconds per run, or that exceed the memory limit are left out.
+    """
+    results = []
+    for protocol in protocols:
+        if not os.path.isfile("./MPSPDZ/" + protocol):
+            print(f"Skipping {protocol}: binary not found")
+            continue
+
+        for batch_size in batch_sizes:
+            print(f"Running {protocol} with batch size {batch_size}")
+            try:
+                runs = [benchmark_kep_ap.run_once(clients, packed, protocol, batch_size, timeout=timeout)
+                        for _ in range(repetitions)]
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as error:
+                print(f"Skipping {protocol} with batch size {batch_size}: {error}")
+                continue
+
+            peak_rss = max(party["peak_rss_kb"] for parties in runs for party in parties)
+            if max_rss_kb and peak_rss > max_rss_kb:
+                print(f"Skipping {protocol} with batch size {batch_size}: peak memory of {peak_rss} KiB")
+                continue
+
+            results.append({"protocol": protocol, "batch_size": batch_size, "peak_rss_kb": peak_rss,
+                            "seconds": statistics.median(phase_seconds(parties) for parties in runs)})
+
+    return sorted(results, key=lambda result: result["seconds"])
+
+
+def store_profile(clients, result):
+    """
+    Store the configuration for the pool size in the profile of this host.
+    """
+    profile = {}
+    if os.path.isfile(run_kep_ap.profile_path()):
+        with open(run_kep_ap.profile_path(), "r") as file:
+            profile = json.load(file)
+
+    profile[str(clients)] = result
+    os.makedirs(run_kep_ap.PROFILE_DIR, exist_ok=True)
+    with open(run_kep_ap.profile_path(), "w") as file:
+        json.dump(profile, file, indent=2, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune protocol backend and batch size of KEP-AP for a pool size.")
+    parser.add_argument("clients", type=int, help="number of patient-donor pairs")
+    parser.add_argument("--protocols", nargs="+", default=PROTOCOLS, help="MP-SPDZ protocol binaries to try")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=BATCH_SIZES, help="batch sizes to try")
+    parser.add_argument("--repetitions", type=int, default=3, help="number of runs per configuration")
+    parser.add_argument("--packed", action="store_true", help="send the HLA indicator vectors bit-packed")
+    parser.add_argument("--max-memory-mb", type=int, help="leave out configurations whose computing peers use more "
+                                                          "memory")
+    parser.add_argument("--timeout", type=float, default=RUN_TIMEOUT,
+                        help="seconds after which a run is stopped and its configuration left out")
+    args = parser.parse_args()
+
+    run_kep_ap.generate_random_input(args.clients)
+    run_kep_ap.setup(args.clients)
+    for ring in sorted({run_kep_ap.is_ring(protocol) for protocol in args.protocols}):
+        run_kep_ap.compile_code(args.clients, args.packed, ring=ring)
+
+    results = tune(args.clients, args.packed, args.protocols, args.batch_sizes, args.repetitions,
+                   args.max_memory_mb and args.max_memory_mb * 1024, args.timeout)
+    if not results:
+        raise SystemExit("No configuration completed")
+
+    print(f"{'protocol':<28} {'batch size':>10} {'seconds':>10} {'peak KiB':>10}")
+    for result in results:
+        print(f"{result['protocol']:<28} {result['batch_size']:>10} {result['seconds']:>10.3f} "
+              f"{result['peak_rss_kb']:>10}")
+
+    store_profile(args.clients, results[0])
+    print(f"Stored {results[0]['protocol']} with batch size {results[0]['batch_size']} in {run_kep_ap.profile_path()}")
+
+
+if __name__ == "__main__":
+    main()